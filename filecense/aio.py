@@ -0,0 +1,151 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# asyncio api, licenses a tree without blocking the event loop
+#
+#   async for path, result, error in license_tree(".", "John Doe"):
+#       ...
+#   counters = await license_tree(".", "John Doe")
+#
+# result is "licensed" for files that got the header, "already_licensed"
+# for ones that had it and "error" for files that could not be licensed,
+# e.g. with no known comment syntax, error is then the message and None
+# otherwise, the others are still licensed. the names are the outcomes of
+# --report. unlike the command line only headers are written, the full
+# LICENSE file is left to the caller
+
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from filecense.logic import license, const_ignore_dirs, const_ignore_files
+from filecense.logic import ignore_items, file_format, finder, licenser
+from filecense.logic import outcome
+
+_done = object()
+
+
+# iterating yields (path, result, error) as files finish, awaiting returns
+# a Counter of results, no LICENSE file is written, concurrency
+# limits files being licensed at once, skip_dirs and skip_files are names
+# or (pattern, "simple" or "regex") tuples
+class license_tree:
+    def __init__(self, path, holder, license_name="eupl", date=None,
+                 comment="", formats=None, skip_dirs=(), skip_files=(),
+                 concurrency=8, verbose=False):
+        try:
+            template = license[license_name].header
+        except KeyError:
+            raise ValueError("license not supported")
+        if date is None:
+            date = datetime.now().year
+        if formats is None:
+            formats = file_format()
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.path = path
+        self.concurrency = concurrency
+        self.finder = finder(verbose,
+                             ignore_items(const_ignore_dirs
+                                          + skip_rules(skip_dirs)),
+                             ignore_items(const_ignore_files
+                                          + skip_rules(skip_files)))
+        self.licenser = outcome(licenser(template, formats, comment, date,
+                                         holder))
+
+    def __await__(self):
+        return self.collect().__await__()
+
+    async def collect(self):
+        counters = Counter()
+        async for _, result, _ in self:
+            counters[result] += 1
+        return counters
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        # one extra thread so the walk never waits on licensing
+        pool = ThreadPoolExecutor(max_workers=self.concurrency + 1)
+        paths = asyncio.Queue(self.concurrency * 2)
+        results = asyncio.Queue(self.concurrency * 2)
+        files = iter(self.finder.get_files(self.path))
+
+        async def walk():
+            while True:
+                batch = await loop.run_in_executor(pool, _take, files, 64)
+                if not batch:
+                    break
+                for f in batch:
+                    await paths.put(f)
+            for _ in range(self.concurrency):
+                await paths.put(_done)
+
+        async def work():
+            while True:
+                f = await paths.get()
+                if f is _done:
+                    break
+                licensed, error, _ = await loop.run_in_executor(
+                    pool, self.licenser, f)
+                await results.put((f, result_name(licensed, error), error))
+            await results.put(_done)
+
+        async def guard(coro):
+            try:
+                await coro
+            except Exception as e:
+                await results.put(e)
+
+        tasks = [loop.create_task(guard(walk()))]
+        tasks += [loop.create_task(guard(work()))
+                  for _ in range(self.concurrency)]
+        try:
+            running = self.concurrency
+            while running:
+                res = await results.get()
+                if res is _done:
+                    running -= 1
+                elif isinstance(res, Exception):
+                    raise res
+                else:
+                    yield res
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            pool.shutdown(wait=False)
+
+
+def result_name(licensed, error):
+    if error is not None:
+        return "error"
+    return "licensed" if licensed else "already_licensed"
+
+
+# plain names are matched exactly
+def skip_rules(items):
+    return [(item, "simple") if isinstance(item, str) else tuple(item)
+            for item in items]
+
+
+def _take(iterator, n):
+    return list(islice(iterator, n))
@@ -0,0 +1,138 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# remembers files that were licensed in earlier runs, so unchanged files
+# can be skipped without being opened
+#
+# file format, integers little endian:
+#   magic b"FLC1", entry count (uint32)
+#   per entry: size (uint64), mtime_ns (int64), inode (uint64),
+#              header fingerprint (8 bytes)
+#   paths of all entries in the same order, separated by NUL bytes,
+#   relative to the directory of the cache file
+
+import os
+import struct
+
+cache_name = ".filecense-cache"
+
+magic = b"FLC1"
+count_format = struct.Struct("<I")
+record_format = struct.Struct("<QqQ8s")
+
+
+class license_cache:
+    def __init__(self, path):
+        self.path = path
+        # entries are kept relative to the cache file, so spelling --path
+        # differently ("./src", "src", absolute) finds the same entries
+        self.base = os.path.dirname(os.path.abspath(path))
+        self.data = {}
+        self.seen = set()
+        self.fingerprints = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        try:
+            self.data = parse(raw)
+        except (ValueError, struct.error):
+            self.data = {}  # unreadable cache is rebuilt
+
+    # 8 byte digest of a rendered header, a changed license, holder, year
+    # or comment syntax gives a different fingerprint
+    def fingerprint(self, top):
+        try:
+            return self.fingerprints[top]
+        except KeyError:
+            import hashlib
+            digest = hashlib.blake2b(top, digest_size=8).digest()
+            self.fingerprints[top] = digest
+            return digest
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.base)
+
+    # True if path was licensed with header top and has not changed since
+    def fresh(self, path, st, top):
+        path = self.key(path)
+        self.seen.add(path)
+        entry = self.data.get(path)
+        if entry is None:
+            return False
+        return entry == (st.st_size, st.st_mtime_ns, st.st_ino,
+                         self.fingerprint(top))
+
+    # notes that path now starts with header top
+    def record(self, path, st, top):
+        path = self.key(path)
+        self.seen.add(path)
+        self.data[path] = (st.st_size, st.st_mtime_ns, st.st_ino,
+                           self.fingerprint(top))
+
+    # with prune only entries looked up or recorded since loading are kept
+    def save(self, prune=False):
+        if prune:
+            data = {k: v for k, v in self.data.items() if k in self.seen}
+        else:
+            data = self.data
+        import tempfile
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory,
+                                   prefix=os.path.basename(self.path) + ".",
+                                   suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(serialize(data))
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+
+def parse(raw):
+    if raw[:len(magic)] != magic:
+        raise ValueError("not a license cache")
+    pos = len(magic)
+    count, = count_format.unpack_from(raw, pos)
+    pos += count_format.size
+    end = pos + count * record_format.size
+    if count == 0:
+        return {}
+    records = record_format.iter_unpack(raw[pos:end])
+    paths = os.fsdecode(raw[end:]).split("\0")
+    if len(paths) != count:
+        raise ValueError("corrupt license cache")
+    return dict(zip(paths, records))
+
+
+def serialize(data):
+    parts = [magic, count_format.pack(len(data))]
+    parts.extend(record_format.pack(*v) for v in data.values())
+    parts.append(os.fsencode("\0".join(data.keys())))
+    return b"".join(parts)
@@ -21,26 +21,16 @@
 #
 
 
+# imports that are not needed on every run are done where they are used,
+# this keeps startup fast for runs on a single file
 import os
-import pathlib
-from datetime import datetime
-import re
-import argparse
-from filecense.templates import euplTop, euplFull
-from filecense.templates import gpl3Top, gpl3, mitTop, mitFull
-from filecense.templates import agplTop, agplFull, mozillaTop, mozillaFull
-from filecense.templates import beerTop, beerFull, unlicenseTop, unlicenseFull
-
-license = {
-        "eupl": [euplTop, euplFull],
-        "gpl3": [gpl3Top, gpl3],
-        "gpl": [gpl3Top, gpl3],
-        "mit": [mitTop, mitFull],
-        "agpl": [agplTop, agplFull],
-        "mozilla": [mozillaTop, mozillaFull],
-        "beer": [beerTop, beerFull],
-        "unlicense": [unlicenseTop, unlicenseFull],
-        }
+import mmap
+import stat
+import time
+from itertools import islice
+from filecense import templates
+
+license = templates.registry
 
 const_ignore_dirs = [
         (".git", "simple"),
@@ -85,11 +75,60 @@ comment_format_by_filere = [  # these are regex strings
         ("Dockerfile", ["#"]),  # this exists as reference, ignored by prog
         ]
 
+header_encoding = "utf-8"  # license headers are written in this encoding
+
+line_limit = 4096  # bytes read at a time while looking for a shebang
+copy_chunk = 1024 * 1024  # bytes copied at a time when rewriting files
+mmap_threshold = 16 * 1024 * 1024  # larger files are mapped, 0 disables
+
 
 def main():
     # parse command line arguments
     args = parser().parse_args()
 
+    if args.profile_out is None:
+        failed = run(args)
+    else:
+        from filecense.profiling import profile_call
+        failed = profile_call(run, (args,), args.profile_out,
+                              args.profile_mode, args.sample_interval)
+    if failed:
+        raise SystemExit(1)
+
+
+# licenses files as parsed command line arguments args say, returns the
+# number of files that could not be licensed, or with --check that are
+# missing a license
+def run(args):
+    if args.report is None:
+        return _run(args, None)
+    import sys
+    from filecense.report import reporter
+    if args.report_file is not None:
+        with open(args.report_file, "w") as f:
+            rep = reporter(f, args.report)
+            try:
+                return _run(args, rep)
+            finally:
+                rep.close()
+    # other output goes to stderr so stdout has only the report
+    import contextlib
+    rep = reporter(sys.stdout, args.report)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            return _run(args, rep)
+    finally:
+        rep.close()
+
+
+def _run(args, rep):
+    from collections import Counter
+    from filecense.timing import phase_timer
+
+    # wall time of each phase, reported with --profile
+    timer = phase_timer()
+    timer.enter("setup")
+
     # initialize class that shares parsed flags with functionality
     i_details = implementation_details(args.verbose, args.regex, args.force)
 
@@ -134,31 +173,235 @@ def main():
         raise SystemExit
 
     # get files and ignore some of them
-    files = finder(args.verbose, ignoredirs, ignorefiles).get_files(args.path)
-
-    # Double check user wants to continue
-    i_details.confirm_continue(files)
+    timer.leave()
+    timer.enter("discover")
+    fndr = finder(args.verbose, ignoredirs, ignorefiles)
+    if rep is not None:
+        fndr.on_ignore = rep.ignored
+    watcher = None
+    if args.watch:
+        if args.changed_since is not None or args.source == "git" or \
+                args.check is not None:
+            print("--watch can't be used with --changed-since, --source git "
+                  "or --check")
+            raise SystemExit
+        from filecense.watch import watch
+        watcher = watch(fndr, None, args.debounce)
+    if watcher is not None:
+        # the walk also starts watching each directory it reaches
+        if args.gitignore:
+            fndr.use_gitignore(args.path)
+        files = fndr.ignore(timer.wrap("walk", watcher.walk(args.path),
+                                       walked_files), entries=True)
+    elif args.changed_since is not None:
+        from filecense.vcs import changed_files
+        try:
+            changed = changed_files(args.path, args.changed_since)
+        except RuntimeError as e:
+            print(e)
+            raise SystemExit
+        files = fndr.filter_paths(args.path, changed)
+    elif args.source == "git":
+        from filecense.vcs import tracked_files
+        try:
+            tracked = tracked_files(args.path)
+        except RuntimeError as e:
+            print(e)
+            raise SystemExit
+        # tracked files can be deleted from the working tree
+        files = (f for f in fndr.filter_paths(args.path, tracked)
+                 if os.path.isfile(f))
+    else:
+        if args.gitignore:
+            fndr.use_gitignore(args.path)
+        files = fndr.ignore(timer.wrap("walk", fndr.find_files(args.path),
+                                       walked_files), entries=True)
+    timer.leave()
+    # listing directories is charged to "walk", ignore rules to "ignore"
+    kept = "discover" if args.changed_since is not None or \
+        args.source == "git" else "ignore"
+    files = timer.wrap(kept, files)
+
+    # Double check user wants to continue, checking changes nothing
+    if args.check is None:
+        with timer.phase("confirm"):
+            files = i_details.confirm_continue(files)
 
     # add license to each source file
-    for f in files:
-        if args.comment == "":
-            # attempt filetype detection by extension
-            format_str = formats.comment_syntax(f)
-        else:
-            format_str = args.comment
-        top = comment_out(lic[0], format_str) % (args.date,
-                                                 license_holder)
-        if not already_has_license(f, top):
-            write_top(top, f)
-        else:
-            print("file ", f, " already has license, skipping")
+    if args.check is None:
+        lcnsr = licenser(lic.header, formats, args.comment, args.date,
+                         license_holder, args.mmap_threshold)
+    else:
+        lcnsr = checker(lic.header, formats, args.comment, args.date,
+                        license_holder)
+    # the timer is not thread safe, with --jobs or --processes only the
+    # whole of licensing is timed and its bytes estimated
+    inline = args.jobs <= 1 and args.processes <= 1
+    if args.profile and inline:
+        lcnsr.timer = timer
+    counters = Counter()
+
+    def skip(f):
+        counters["cached"] += 1
+        timer.count("cache", files=1)
+        print("file ", os.fspath(f), " already has license, skipping")
+        if rep is not None:
+            rep.cached(os.fspath(f))
+
+    # files licensed in an earlier run and unchanged since are not opened
+    cache = None
+    if args.cache is not None:
+        from filecense.cache import license_cache, cache_name
+        top = args.path if os.path.isdir(args.path) else \
+            os.path.dirname(args.path)
+        cache = license_cache(args.cache or os.path.join(top, cache_name))
+        files = timer.wrap("cache", stale_files(files, cache, lcnsr, skip))
+    # licensing outcomes are counted by the executors, checks by
+    # check_results
+    tally = counters if args.check is None else None
+    if args.processes > 1:
+        results = execute_processes(outcome(lcnsr), files, args.processes,
+                                    tally)
+    else:
+        results = execute(outcome(lcnsr), files, args.jobs, tally)
+    if args.check is not None:
+        with timer.phase("check"):
+            check_results(results, args.check == "first", lcnsr, counters,
+                          rep)
+        timer.count("check", counters[False] + counters["missing"] +
+                    counters["error"])
+        if args.verbose:
+            print("Checked ", counters[False] + counters["missing"],
+                  " files, ", counters["missing"], " without a license")
+        return finish(args, timer, fndr, counters)
+    with timer.phase("license"):
+        for f, (licensed, error, seconds) in results:
+            path = os.fspath(f)
+            if error is not None:
+                print("error: ", path, ": ", error)
+                if rep is not None:
+                    rep.error(path, error, lcnsr.syntax_or_none(path),
+                              seconds)
+                continue
+            if not licensed:
+                print("file ", path, " already has license, skipping")
+            if cache is None and not args.profile and rep is None:
+                continue
+            st = os.stat(path)
+            top = lcnsr.header(path)[1]
+            read, written = transferred(st, top, licensed)
+            if cache is not None:
+                cache.record(path, st, top)
+            if args.profile and inline:
+                timer.count("license", 1)
+            elif args.profile:
+                timer.count("license", 1, read, written)
+            if rep is not None:
+                rep.licensed(path, licensed, lcnsr.syntax(path), written,
+                             seconds)
+    if cache is not None:
+        with timer.phase("cache"):
+            # entries of files outside a partial run are still valid
+            cache.save(prune=args.changed_since is None)
+    if args.verbose:
+        print("Licensed ", counters[True], " files, ",
+              counters[False] + counters["cached"],
+              " already had a license")
 
     # add full text
-    location = find_root(args.path)
-    i_details.write_license(lic[1], location, args.license_file_name)
+    with timer.phase("find_root"):
+        location = find_root(args.path, fndr.git_root)
+    with timer.phase("full text"):
+        if i_details.write_license(lic.full, location,
+                                   args.license_file_name):
+            timer.count("full text", 1, 0, len(lic.full.encode()))
+    if watcher is not None:
+        print("Watching ", args.path, " for new files, stop with Ctrl-C")
+
+        def handle(path, res):
+            licensed, error, seconds = res
+            if error is not None:
+                counters["error"] += 1
+                print("error: ", path, ": ", error)
+                if rep is not None:
+                    rep.error(path, error, lcnsr.syntax_or_none(path),
+                              seconds)
+                return
+            counters[licensed] += 1
+            if licensed:
+                print("licensed: ", path)
+            if rep is not None:
+                written = os.path.getsize(path) if licensed else 0
+                rep.licensed(path, licensed, lcnsr.syntax(path), written,
+                             seconds)
+            if cache is not None:
+                try:
+                    cache.record(path, os.stat(path), lcnsr.header(path)[1])
+                except OSError:  # gone again
+                    pass
+        watcher.func = outcome(lcnsr)
+        with timer.phase("watch"):
+            watcher.run(handle)
+        if cache is not None:
+            with timer.phase("cache"):
+                cache.save(prune=True)
+    return finish(args, timer, fndr, counters)
+
+
+# prints the --profile summary and returns the number of failed files
+def finish(args, timer, fndr, counters):
+    if args.profile:
+        import sys
+        totals = [("ignored", fndr.skipped),
+                  ("skipped by cache", counters["cached"]),
+                  ("already licensed", counters[False])]
+        if args.check is None:
+            totals.append(("newly licensed", counters[True]))
+        else:
+            totals.append(("missing", counters["missing"]))
+        totals.append(("errors", counters["error"]))
+        print(timer.summary(totals), file=sys.stderr)
+    return counters["error"] + counters["missing"]
+
+
+# counts results of a checker, with first the first file that is missing a
+# license or fails ends the check and work that has not started is dropped
+def check_results(results, first, lcnsr, counters, rep):
+    try:
+        for f, (present, error, seconds) in results:
+            path = os.fspath(f)
+            if error is not None:
+                counters["error"] += 1
+                print("error: ", path, ": ", error)
+                if rep is not None:
+                    rep.error(path, error, lcnsr.syntax_or_none(path),
+                              seconds)
+            elif present:
+                counters[False] += 1
+                if rep is not None:
+                    rep.checked(path, True, lcnsr.syntax(path), seconds)
+            else:
+                counters["missing"] += 1
+                print("missing license: ", path)
+                if rep is not None:
+                    rep.checked(path, False, lcnsr.syntax(path), seconds)
+            if first and (error is not None or not present):
+                break
+    finally:
+        results.close()
+
+
+# approximate (bytes read, bytes written) for licensing a file that now has
+# stat result st, a licensed file was copied behind its new header, only the
+# start of the others was read. used when licensing is not timed inline
+def transferred(st, top, licensed):
+    if licensed:
+        return st.st_size - len(top), st.st_size
+    return min(st.st_size, prefix_size(top)), 0
 
 
 def parser():
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("license_holder",
                         help="Name of licence holder."
@@ -167,13 +410,13 @@ def parser():
                         "Default license: EUPL",
                         nargs=argparse.REMAINDER, default="")
     parser.add_argument("-p", "--path",
-                        help="Specifies path to parse, "
-                        "defaults to current directory",
+                        help="Specifies path to parse, a directory or a "
+                        "single file, defaults to current directory",
                         default=".")
     parser.add_argument("-d", "--date",
                         help="Date as year (int) to use",
                         type=int,
-                        default=datetime.now().year)
+                        default=time.localtime().tm_year)
     parser.add_argument("-l", "--license",
                         help="Specifies license to add",
                         default="eupl")
@@ -217,6 +460,90 @@ def parser():
     parser.add_argument("-v", "--verbose",
                         help="Increased verbosity",
                         action="store_true")
+    parser.add_argument("-j", "--jobs",
+                        help="Number of files to license concurrently, "
+                        "default 1",
+                        type=int,
+                        default=1)
+    parser.add_argument("-P", "--processes",
+                        help="Number of worker processes to license files "
+                        "with, overrides --jobs",
+                        type=int,
+                        default=1)
+    parser.add_argument("--source",
+                        help="Where to find files, 'walk' walks the "
+                        "directory tree, 'git' lists files tracked by git. "
+                        "Default walk",
+                        choices=["walk", "git"],
+                        default="walk")
+    parser.add_argument("-gi", "--gitignore",
+                        help="Also skip what .gitignore files and "
+                        ".git/info/exclude ignore when walking",
+                        action="store_true")
+    parser.add_argument("--changed-since",
+                        help="Only license files added or modified since "
+                        "the given git ref, and new untracked files",
+                        metavar="REF")
+    parser.add_argument("--cache",
+                        help="Skip files that were licensed in an earlier "
+                        "run and have not changed, remembered in the given "
+                        "file, default PATH/.filecense-cache. "
+                        "Make sure you have a flag before license holder",
+                        nargs="?", const="")
+    parser.add_argument("--mmap-threshold",
+                        help="Size in bytes from which files are memory "
+                        "mapped instead of read, 0 disables, "
+                        "default %d" % mmap_threshold,
+                        type=int,
+                        default=mmap_threshold)
+    parser.add_argument("--check",
+                        help="Only check that files have the license, "
+                        "nothing is written. Stops at the first file "
+                        "without one, 'all' checks every file. Exits with "
+                        "1 if any file is missing a license. Make sure you "
+                        "have a flag before license holder",
+                        nargs="?", const="first", choices=["first", "all"])
+    parser.add_argument("--watch",
+                        help="After licensing, keep watching the tree and "
+                        "license new files as they are created or moved in",
+                        action="store_true")
+    parser.add_argument("--debounce",
+                        help="Seconds a new file must stay unchanged before "
+                        "--watch licenses it, default 0.5",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--profile",
+                        help="Print wall time, files per second and bytes "
+                        "read and written of each phase when done, e.g. "
+                        "walk, ignore, detect and write. With --jobs or "
+                        "--processes detection and writing are timed "
+                        "together as license, with bytes estimated from "
+                        "file sizes",
+                        action="store_true")
+    parser.add_argument("--profile-out",
+                        help="Profile the run, including --jobs threads but "
+                        "not --processes workers, and write the profile to "
+                        "the given file",
+                        metavar="FILE")
+    parser.add_argument("--profile-mode",
+                        help="'cprofile' writes pstats of every call, "
+                        "'sample' writes collapsed stacks of all threads "
+                        "sampled every --sample-interval with little "
+                        "overhead. Default cprofile",
+                        choices=["cprofile", "sample"],
+                        default="cprofile")
+    parser.add_argument("--sample-interval",
+                        help="Seconds between stack samples, default 0.005",
+                        type=float,
+                        default=0.005)
+    parser.add_argument("--report",
+                        help="Write the outcome of every path as it happens, "
+                        "'jsonl' writes an object per line, 'json' an array",
+                        choices=["json", "jsonl"])
+    parser.add_argument("--report-file",
+                        help="Write the report to the given file instead of "
+                        "stdout, other output stays on stdout",
+                        metavar="FILE")
     return parser
 
 
@@ -243,45 +570,295 @@ class implementation_details:
                     else:
                         obj.set_simple(ignore)
 
+    # returns files to license, with force files are passed on as they
+    # are found instead of being listed and counted first
     def confirm_continue(self, files):
+        if self.force:
+            return self.stream_files(files)
+        files = list(files)
         if self.verbose:
             print("About to add licence to:")
             for f in files:
-                print("\t", f)
+                print("\t", os.fspath(f))
         else:
             print("Adding license to ", len(files), " files")
-        if self.force:
-            return
         response = input("continue? (y/N)\n")
         if response != 'y':
             print("execution stopped by user")
             raise SystemExit
-
-    def print_licenses():
+        return files
+
+    def stream_files(self, files):
+        print("Adding license to files as they are found")
+        count = 0
+        for f in files:
+            if self.verbose:
+                print("\t", os.fspath(f))
+            count += 1
+            yield f
+        print("Found ", count, " files")
+
+    def print_licenses(self):
         for lic in license:
             print(lic)
         raise SystemExit
 
+    # returns True if the file was written
     def write_license(self, license, location, filename):
         try:
             write_full(license, location, filename, "x")
         except FileExistsError:
             if self.force:
-                return
+                return False
             resp = input("Full license already exists, overwrite? (y/n)\n")
             if resp != 'y':
                 raise SystemExit
             else:
                 write_full(license, location, filename, "w")
+        return True
 
 
-def find_root(path):
-    tuples = os.walk(path, topdown=True)
-    for root, dirs, files in tuples:
-        for d in dirs:
-            if d == ".git":
-                return os.path.abspath(root)
-    return os.path.abspath(path)
+# commented and formatted license headers, there are only a handful of
+# distinct ones per licenser so each is rendered and encoded once
+class header_cache:
+    def __init__(self):
+        self.data = {}
+
+    # returns header as (str, bytes)
+    def get(self, template, comment, date, holder):
+        key = (template, tuple(comment), date, holder)
+        try:
+            return self.data[key]
+        except KeyError:
+            text = comment_out(template, list(comment)) % (date, holder)
+            self.data[key] = (text, text.encode(header_encoding))
+            return self.data[key]
+
+
+# adds license header to a single file, returns False if it already had one
+class licenser:
+    def __init__(self, template, formats, comment, date, holder,
+                 mmap_threshold=mmap_threshold):
+        self.template = template
+        self.formats = formats
+        # comment syntax can also be given as on the command line, "<!--,-->"
+        if isinstance(comment, str):
+            comment = comment.split(",") if comment != "" else ""
+        self.comment = comment
+        self.date = date
+        self.holder = holder
+        self.mmap_threshold = mmap_threshold
+        self.headers = header_cache()  # one per licenser, freed with it
+        self.timer = untimed  # a phase_timer if files are licensed inline
+
+    def syntax(self, path):
+        if self.comment == "":
+            # attempt filetype detection by extension
+            return self.formats.comment_syntax(path)
+        return self.comment
+
+    def syntax_or_none(self, path):
+        try:
+            return self.syntax(path)
+        except (KeyError, ValueError):
+            return None
+
+    def top(self, path):
+        return self.header(path)[0]
+
+    # returns rendered header as (str, bytes)
+    def header(self, path):
+        return self.render(self.syntax(path))
+
+    def render(self, format_str):
+        return self.headers.get(self.template, format_str, self.date,
+                                self.holder)
+
+    # renders headers for every known comment syntax ahead of time
+    def preload(self):
+        if self.comment != "":
+            self.render(self.comment)
+            return
+        for format_str in self.formats.ext.values():
+            self.render(format_str)
+        for _, format_str in self.formats.fileregex:
+            self.render(format_str)
+
+    # path can be a path or an os.DirEntry
+    def __call__(self, path):
+        is_link = None
+        if isinstance(path, os.DirEntry):
+            is_link = path.is_symlink()
+        path = os.fspath(path)
+        return license_file(path, self.header(path)[1], is_link,
+                            self.mmap_threshold, self.timer)
+
+
+# read-only licenser, calling it returns True if the file has the header
+# and reads no more of the file than the header could take up
+class checker(licenser):
+    def __call__(self, path):
+        path = os.fspath(path)
+        return already_has_license(path, self.header(path)[1])
+
+
+# yields files that cache does not know to be licensed with their current
+# header, the others are passed to skip, files with no header are passed
+# on so licensing them reports the error
+def stale_files(files, cache, lcnsr, skip):
+    for f in files:
+        path = os.fspath(f)
+        st = f.stat() if isinstance(f, os.DirEntry) else os.stat(path)
+        try:
+            top = lcnsr.header(path)[1]
+        except (KeyError, ValueError):
+            yield f
+            continue
+        if cache.fresh(path, st, top):
+            skip(f)
+        else:
+            yield f
+
+
+# calls func on a file and returns (result, error, seconds), a problem with
+# the file is returned as its message so the rest of the run goes on
+class outcome:
+    def __init__(self, func):
+        self.func = func
+
+    def preload(self):
+        if hasattr(self.func, "preload"):
+            self.func.preload()
+
+    def __call__(self, path):
+        start = time.perf_counter()
+        try:
+            res = self.func(path)
+            error = None
+        except (OSError, ValueError, KeyError) as e:
+            res = None
+            error = "%s: %s" % (type(e).__name__, e)
+        return res, error, time.perf_counter() - start
+
+    # what a result is counted as, failed files as "error"
+    @staticmethod
+    def key(res):
+        return res[0] if res[1] is None else "error"
+
+
+# yields (item, func(item)) in input order, running up to jobs calls at once
+# at most jobs files are open at a time and only a small window of results
+# is held in memory, so items can be a lazy iterable
+def execute(func, items, jobs=1, counters=None):
+    key = counter_key(func)
+    for item, res in _execute(func, items, jobs):
+        if counters is not None:
+            counters[key(res)] += 1
+        yield item, res
+
+
+# results are counted as themselves unless func says otherwise
+def counter_key(func):
+    return getattr(func, "key", _same)
+
+
+def _same(res):
+    return res
+
+
+def _execute(func, items, jobs):
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append((item, pool.submit(func, item)))
+                if len(pending) >= jobs * 2:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            # closed early, only wait for calls that already started
+            for _, future in pending:
+                future.cancel()
+
+
+# same as execute but partitions items into chunks handled by worker
+# processes, func is sent to each worker once and must be picklable
+def execute_processes(func, items, processes, counters=None,
+                      chunksize=256):
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    items = iter(items)
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=_init_worker,
+                             initargs=(func,)) as pool:
+        pending = deque()
+        try:
+            while True:
+                chunk = [os.fspath(i) for i in islice(items, chunksize)]
+                if chunk:
+                    pending.append((chunk, pool.submit(_run_chunk, chunk)))
+                if pending and (not chunk or len(pending) >= processes * 2):
+                    chunk, future = pending.popleft()
+                    results, chunk_counters = future.result()
+                    if counters is not None:
+                        counters.update(chunk_counters)
+                    yield from zip(chunk, results)
+                elif not chunk:
+                    break
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+# per process state of execute_processes workers
+_worker_func = None
+
+
+def _init_worker(func):
+    global _worker_func
+    if hasattr(func, "preload"):
+        func.preload()
+    _worker_func = func
+
+
+def _run_chunk(chunk):
+    from collections import Counter
+    results = [_worker_func(item) for item in chunk]
+    return results, Counter(map(counter_key(_worker_func), results))
+
+
+# returns directory for the full license: found, the first directory of
+# the walk with a .git in it, otherwise the closest directory at or above
+# path that has one, otherwise path or the directory of a single file.
+# each directory is looked at once per call and nothing is kept between
+# calls, so a later run, e.g. with --watch, sees a new or removed .git
+def find_root(path, found=None):
+    if found is not None:
+        return found
+    start = os.path.abspath(path)
+    if not os.path.isdir(start):
+        start = os.path.dirname(start)
+    directory = start
+    while True:
+        if has_git(directory):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return start
+        directory = parent
+
+
+def has_git(directory):
+    return os.path.lexists(os.path.join(directory, ".git"))
 
 
 def write_full(text, location, name, open_opt):
@@ -289,32 +866,288 @@ def write_full(text, location, name, open_opt):
         f.write(text)
 
 
+# only reads the shebang line and as many bytes as the header has
 def already_has_license(filepath, top):
-    regex = re.compile("^#!/.+$")
-    with open(filepath, "r") as f:
-        content = f.read().split("\n")
-        if regex.match(content[0]):
-            content = content[1:]
-        return "\n".join(content).startswith(top)
+    if isinstance(top, str):
+        top = top.encode(header_encoding)
+    with open(filepath, "rb") as f:
+        skip_shebang(f)
+        prefix = f.read(prefix_size(top))
+    return has_header(prefix, top)
+
+
+# bytes to read to find header top, with room for \r\n line endings
+def prefix_size(top):
+    return len(top) + top.count(b"\n")
+
+
+def has_header(prefix, top):
+    if prefix.startswith(top):
+        return True
+    return prefix.replace(b"\r\n", b"\n").startswith(top)
+
+
+# same as already_has_license followed by write_top but opens the file once,
+# the shebang and header are probed from one read that is reused for writing
+# files of at least mmap_threshold bytes are mapped instead of read, 0 turns
+# mapping off. time and bytes of finding the header and of writing are
+# charged to the "detect" and "write" phases of timer. returns False if the
+# file already had the header
+def license_file(path, top, is_link=None, mmap_threshold=mmap_threshold,
+                 timer=None):
+    if isinstance(top, str):
+        top = top.encode(header_encoding)
+    if timer is None:
+        timer = untimed
+    if is_link is None:
+        is_link = os.path.islink(path)
+    if is_link:  # replace the target, not the link
+        path = os.path.realpath(path)
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        in_place = rewrite_in_place(path, st)
+        if 0 < mmap_threshold <= st.st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                tmp = license_mapped(path, mm, top, in_place, timer)
+        else:
+            tmp = license_buffered(path, f, top, in_place, mmap_threshold,
+                                   timer)
+    if tmp is None:
+        return False
+    with timer.phase("write"):
+        commit_temp(tmp, path, st, in_place)
+    return True
+
+
+# returns temp file with header added or None if f already had it
+def license_buffered(path, f, top, in_place=False,
+                     mmap_threshold=mmap_threshold, timer=None):
+    if timer is None:
+        timer = untimed
+    with timer.phase("detect"):
+        want = prefix_size(top)
+        buf = f.read(line_limit + want)
+        start = 0
+        if buf.startswith(b"#!/"):
+            start = buf.find(b"\n") + 1
+            if start == 0:  # shebang longer than the read or no newline
+                buf += f.readline()
+                start = buf.find(b"\n") + 1 or len(buf)
+                buf += f.read(want)
+            if not is_shebang(buf[:start]):
+                start = 0
+        found = has_header(buf[start:start + want], top)
+    timer.count("detect", 1, len(buf))
+    if found:
+        return None
+    with timer.phase("write"):
+        line = buf[:start]
+        if line and not line.endswith(b"\n"):  # file is only a shebang
+            line += b"\n"
+        parts = [line, top, b"\n", buf[start:]]
+        rest = os.fstat(f.fileno()).st_size - f.tell()
+        tmp = write_temp(path, parts, f, in_place, mmap_threshold)
+    timer.count("write", 1, rest, sum(map(len, parts)) + rest)
+    return tmp
+
+
+# same as license_buffered but compares and copies straight from the mapping
+def license_mapped(path, mm, top, in_place=False, timer=None):
+    if timer is None:
+        timer = untimed
+    with memoryview(mm) as view:
+        with timer.phase("detect"):
+            start = 0
+            if mm[:3] == b"#!/":
+                start = mm.find(b"\n") + 1 or len(mm)
+                if not is_shebang(mm[:start]):
+                    start = 0
+            found = view[start:start + len(top)] == top or \
+                has_header(mm[start:start + prefix_size(top)], top)
+        timer.count("detect", 1, min(len(mm), start + prefix_size(top)))
+        if found:
+            return None
+        with timer.phase("write"):
+            line = view[:start]
+            parts = [line, top, b"\n"]
+            if start and line[-1] != ord("\n"):  # file is only a shebang
+                parts.insert(1, b"\n")
+            parts += [view[i:i + copy_chunk]
+                      for i in range(start, len(view), copy_chunk)]
+            try:
+                tmp = write_temp(path, parts, in_place=in_place)
+                written = sum(map(len, parts))
+            finally:
+                for part in parts:
+                    if isinstance(part, memoryview):
+                        part.release()
+        timer.count("write", 1, len(mm) - start, written)
+        return tmp
+
+
+# stands in for a timing.phase_timer when nothing is timed
+class _untimed:
+    def phase(self, name):
+        return self
+
+    def count(self, name, files=0, read=0, written=0):
+        pass
 
+    def __enter__(self):
+        return None
 
+    def __exit__(self, *exc):
+        pass
+
+
+untimed = _untimed()
+
+
+# True if line, up to its first newline, is a "#!/..." line
+def is_shebang(line):
+    return line.startswith(b"#!/") and len(line) - line.endswith(b"\n") > 3
+
+
+# moves binary file f past a leading shebang line, or back to the start
+def skip_shebang(f):
+    line = f.readline(line_limit)
+    if not is_shebang(line):
+        f.seek(0)
+        return
+    while line and not line.endswith(b"\n"):  # longer than line_limit
+        line = f.readline(line_limit)
+
+
+# inserts header after any shebang line, the file is rewritten in chunks
+# to a temporary copy that replaces it so it is never left half written,
+# see rewrite_in_place for when it is written over instead
 def write_top(ntop, path):
-    regex = re.compile("^#!/.+$")
-    f = open(path, 'r')
-    line = f.readline()
-    mark = False
-    if regex.search(line) is not None:
-        mark = True
+    if isinstance(ntop, str):
+        ntop = ntop.encode(header_encoding)
+    if os.path.islink(path):  # replace the target, not the link
+        path = os.path.realpath(path)
+    with open(path, "rb") as src:
+        skip_shebang(src)
+        end = src.tell()
+        src.seek(0)
+        line = src.read(end)
+        if line and not line.endswith(b"\n"):  # file is only a shebang
+            line += b"\n"
+        st = os.fstat(src.fileno())
+        in_place = rewrite_in_place(path, st)
+        tmp = write_temp(path, [line, ntop, b"\n"], src, in_place,
+                         mmap_threshold)
+    commit_temp(tmp, path, st, in_place)
+
+
+# True if file path with stat result st has to be written over instead of
+# replaced, a new file would leave its other hard links without the header
+# and can't be created in a directory that is not writable
+def rewrite_in_place(path, st):
+    return st.st_nlink > 1 or \
+        not os.access(os.path.dirname(path) or ".", os.W_OK)
+
+
+# writes parts followed by the rest of binary file src to a temporary file
+# and returns its name, the rest is copied from a read only mapping if it
+# has at least mmap_threshold bytes.
+# the file is next to path, or in the temporary directory if path is
+# rewritten in place
+def write_temp(path, parts, src=None, in_place=False,
+               mmap_threshold=mmap_threshold):
+    import tempfile
+    fd, tmp = tempfile.mkstemp(
+        dir=None if in_place else os.path.dirname(path) or ".",
+        prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            dst.writelines(parts)
+            if src is not None:
+                copy_rest(src, dst, mmap_threshold)
+            if not in_place:  # on disk before it replaces path
+                dst.flush()
+                os.fsync(dst.fileno())
+    except BaseException:
+        discard(tmp)
+        raise
+    return tmp
+
+
+# moves temporary file from write_temp over path, which had stat result
+# st, with the same mode, owner and extended attributes, or copies it into
+# path if it is rewritten in place
+def commit_temp(tmp, path, st, in_place=False):
+    if in_place:
+        try:
+            copy_back(tmp, path)
+        finally:
+            discard(tmp)
+        return
+    try:
+        copy_owner(tmp, st)
+        copy_xattrs(path, tmp)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        discard(tmp)
+        raise
+
+
+# only root can give files away, others keep the file as their own
+def copy_owner(tmp, st):
+    if not hasattr(os, "chown"):
+        return
+    try:
+        os.chown(tmp, st.st_uid, st.st_gid)
+    except PermissionError:
         pass
-    else:
-        f.seek(0)  # reset file position
-    saved = f.read()
-    f.close()
-    f = open(path, 'w')
-    if mark:
-        f.write(line)
-    f.writelines([ntop, "\n", saved])
-    f.close()
+
+
+# extended attributes, which also hold acls on linux, are copied where the
+# filesystem takes them
+def copy_xattrs(src, dst):
+    if not hasattr(os, "listxattr"):
+        return
+    try:
+        names = os.listxattr(src)
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.setxattr(dst, name, os.getxattr(src, name))
+        except OSError:
+            pass
+
+
+# writes the contents of tmp over path, the inode and its links stay
+def copy_back(tmp, path):
+    import shutil
+    with open(tmp, "rb") as src, open(path, "r+b") as dst:
+        shutil.copyfileobj(src, dst, copy_chunk)
+        dst.truncate()
+        dst.flush()
+        os.fsync(dst.fileno())
+
+
+def discard(tmp):
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+
+def copy_rest(src, dst, mmap_threshold=mmap_threshold):
+    pos = src.tell()
+    size = os.fstat(src.fileno()).st_size
+    if 0 < mmap_threshold <= size - pos:
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                for i in range(pos, len(view), copy_chunk):
+                    with view[i:i + copy_chunk] as chunk:
+                        dst.write(chunk)
+        return
+    import shutil
+    shutil.copyfileobj(src, dst, copy_chunk)
 
 
 def comment_out(text, comment):
@@ -376,9 +1209,11 @@ class file_format:
         self.fileregex.append((filere, comment_syntax))
 
     def comment_syntax(self, name):
-        if pathlib.PurePath(name).suffix != "":
-            return self.ext[pathlib.PurePath(name).suffix[1:]]
+        suffix = os.path.splitext(name)[1]
+        if len(suffix) > 1:
+            return self.ext[suffix[1:]]
         else:
+            import re
             for filere, comment in self.fileregex:
                 regex = re.compile(filere)
                 if regex.match(name):
@@ -389,11 +1224,14 @@ class file_format:
 class ignore_items:
     def __init__(self, items=None):
         self.data = {}
+        self.compiled = {}
+        self.matcher = None
         if items is not None:
             self.add_items(items)
 
     def __setitem__(self, k, v):
         self.data[k] = v
+        self.matcher = None  # recompiled on next ignore call
 
     def __getitem__(self, k):
         return self.data[k]
@@ -409,11 +1247,59 @@ class ignore_items:
                 self.set_simple(k)
 
     def ignore(self, item):
-        for key in self:
-            if self[key](key, item):
+        if self.matcher is None:
+            self.compile()
+        simple, regexes, others = self.matcher
+        if item in simple:
+            return True
+        for regex in regexes:
+            if regex.search(item) is not None:
+                return True
+        for key, check in others:
+            if check(key, item):
                 return True
         return False
 
+    # returns the rule that ignores item or None, slower than ignore so
+    # only used to tell why an item was ignored
+    def rule(self, item):
+        for key, check in self.data.items():
+            if check(key, item):
+                return key
+        return None
+
+    # builds matcher from rules: a set of simple names, as few regexes as
+    # possible and any custom checks that can't be merged
+    def compile(self):
+        import re
+        simple = []
+        patterns = []
+        others = []
+        for key, check in self.data.items():
+            if check == self.simple_check:
+                simple.append(key)
+            elif check == self.regex_check:
+                patterns.append(key)
+            else:
+                others.append((key, check))
+        regexes = []
+        mergeable = []
+        for pattern in patterns:
+            # group numbers shift when merged, so backreferences stay apart
+            if re.search(r"\\[1-9]|\(\?P=", pattern) is not None:
+                regexes.append(self.pattern(pattern))
+            else:
+                mergeable.append(pattern)
+        if len(mergeable) == 1:
+            regexes.append(self.pattern(mergeable[0]))
+        elif mergeable:
+            try:
+                regexes.append(re.compile("|".join("(?:%s)" % p
+                                                   for p in mergeable)))
+            except re.error:  # e.g. inline flags, keep them separate
+                regexes.extend(self.pattern(p) for p in mergeable)
+        self.matcher = (frozenset(simple), regexes, others)
+
     def set_simple(self, name):
         self[name] = self.simple_check
 
@@ -427,46 +1313,205 @@ class ignore_items:
             return False
 
     def regex_check(self, matchTo, toMatch):
-        regex = re.compile(matchTo)
-        res = regex.search(toMatch)
+        res = self.pattern(matchTo).search(toMatch)
         if (res is not None):
             return True
         else:
             return False
 
+    def pattern(self, matchTo):
+        if matchTo not in self.compiled:
+            import re
+            self.compiled[matchTo] = re.compile(matchTo)
+        return self.compiled[matchTo]
+
 
 class finder:
     def __init__(self, verbose, ignore_dirs, ignore_files):
         self.verbose = verbose
         self.ignore_dirs = ignore_dirs
         self.ignore_files = ignore_files
+        self.gitignore = None
+        self.gitignores = {}  # matchers of dirs waiting to be walked
+        self.matchers = None  # matchers of walked dirs, kept if a dict
+        self.git_root = None  # first walked directory with a .git
+        self.skipped = 0  # files left out by ignore rules
+        self.on_ignore = None  # called with (path, rule, is_dir)
+
+    # makes walks from path also skip what .gitignore files ignore
+    def use_gitignore(self, path):
+        from filecense.vcs import load_gitignore
+        self.gitignore = load_gitignore(path)
 
     def get_files(self, path):
         return self.ignore(self.find_files(path))
 
-    def find_files(self, path):
-        return os.walk(path, topdown=True)
-
-    # returns files after ignoring relevant files
-    def ignore(self, all_files):
-        res = []
+    # same as get_files but yields os.DirEntry objects, which keep the file
+    # type from the directory listing and cache stat results
+    def get_entries(self, path):
+        return self.ignore(self.find_files(path), entries=True)
+
+    # walks like os.walk(path, topdown=True) but dirs and files are lists of
+    # os.DirEntry, entries are classified without extra stat calls where the
+    # filesystem reports their type. enter is called with each directory
+    # right before it is listed
+    def find_files(self, path, enter=None):
+        if os.path.isfile(path):  # a single file is its own tree
+            if enter is not None:
+                enter(os.path.dirname(path))
+            yield os.path.dirname(path), [], [os.path.basename(path)]
+            return
+        stack = [path]
+        while stack:
+            root = stack.pop()
+            if enter is not None:
+                enter(root)
+            try:
+                with os.scandir(root) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            dirs = []
+            files = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+            yield root, dirs, files
+            # dirs may have been pruned by the caller, like os.walk
+            for entry in reversed(dirs):
+                if not entry.is_symlink():
+                    stack.append(entry.path)
+
+    # yields files after ignoring relevant files, directories are pruned
+    # as the walk reaches them so licensing can start right away
+    def ignore(self, all_files, entries=False):
         for root, dirs, files in all_files:
-            self.ignoreItems(True, dirs)
-            self.ignoreItems(False, files)
+            if self.git_root is None and (".git" in map(item_name, dirs) or
+                                          ".git" in map(item_name, files)):
+                self.git_root = os.path.abspath(root)
+            if self.gitignore is not None:
+                has_gitignore = ".gitignore" in map(item_name, files)
+            found = len(files)
+            self.ignoreItems(True, dirs, root)
+            self.ignoreItems(False, files, root)
+            if self.gitignore is not None:
+                self.ignoreGit(root, dirs, files, has_gitignore)
+            self.skipped += found - len(files)
             for f in files:
-                res.append(os.path.join(root, f))
-        return res
-
-    def ignoreItems(self, dirs, items):
-        ignores = self.ignore_dirs if dirs else self.ignore_files
-        while True:  # restart from topafter deleting an element
-            i = 0
+                if entries and isinstance(f, os.DirEntry):
+                    yield f
+                else:
+                    yield item_path(root, f)
+
+    # yields root joined with relative paths that pass the same ignore rules
+    # as the walk, each directory along a path is checked once
+    def filter_paths(self, root, paths):
+        dirs = {"": False}
+        for rel in paths:
+            head, name = os.path.split(rel)
+            if self.ignored_dir(head, dirs) or \
+                    self.ignore_files.ignore(name):
+                if self.verbose:
+                    print("skipping: ", os.path.join(root, rel))
+                if self.on_ignore is not None:
+                    self.on_ignore(os.path.join(root, rel),
+                                   self.path_rule(head, name), False)
+                self.skipped += 1
+                continue
+            yield os.path.join(root, rel)
+
+    # rule that ignores relative path head/name, the outermost directory
+    # that is ignored decides
+    def path_rule(self, head, name):
+        parts = [p for p in head.split(os.sep) if p]
+        for part in parts:
+            if self.ignore_dirs.ignore(part):
+                return self.ignore_dirs.rule(part)
+        return self.ignore_files.rule(name)
+
+    # returns True if any part of relative directory path is ignored
+    def ignored_dir(self, path, dirs):
+        if path not in dirs:
+            head, name = os.path.split(path)
+            dirs[path] = self.ignored_dir(head, dirs) or \
+                self.ignore_dirs.ignore(name)
+        return dirs[path]
+
+    # removes what .gitignore files ignore from a step of the walk, rules
+    # found in root are passed down to the dirs that are kept
+    def ignoreGit(self, root, dirs, files, has_gitignore):
+        matcher = self.gitignores.pop(root, self.gitignore)
+        if has_gitignore:
+            from filecense.vcs import read_lines
+            matcher = matcher.child(os.path.join(root, ""), "", read_lines(
+                os.path.join(root, ".gitignore")))
+        if self.matchers is not None:
+            self.matchers[root] = matcher
+        for is_dir, items in [(True, dirs), (False, files)]:
+            kept = 0
             for item in items:
-                if ignores.ignore(item):
+                path = item_path(root, item)
+                if matcher.ignored(path, item_name(item), is_dir):
                     if self.verbose:
-                        print("skipping: ", os.path.abspath(item))
-                    items.remove(item)
-                    break
-                i += 1
-            if i >= len(items):
-                break
+                        print("skipping: ", path)
+                    if self.on_ignore is not None:
+                        self.on_ignore(path, ".gitignore", is_dir)
+                else:
+                    items[kept] = item
+                    kept += 1
+            del items[kept:]
+        for d in dirs:
+            self.gitignores[item_path(root, d)] = matcher
+
+    # removes ignored items in place, needed for the walk to skip dirs
+    # items are names in root or os.DirEntry objects
+    def ignoreItems(self, dirs, items, root=None):
+        ignores = self.ignore_dirs if dirs else self.ignore_files
+        kept = 0
+        for item in items:
+            name = item_name(item)
+            if ignores.ignore(name):
+                if name is not item:
+                    path = item.path
+                elif root is not None:
+                    path = os.path.join(root, item)
+                else:
+                    path = os.path.abspath(item)
+                if self.verbose:
+                    print("skipping: ", path)
+                if self.on_ignore is not None:
+                    self.on_ignore(path, ignores.rule(name), dirs)
+            else:
+                items[kept] = item
+                kept += 1
+        del items[kept:]
+
+
+# files listed by a step of the walk, before ignore rules
+def walked_files(step):
+    return len(step[2])
+
+
+def item_name(item):
+    if isinstance(item, os.DirEntry):
+        return item.name
+    return item
+
+
+def item_path(root, item):
+    if isinstance(item, os.DirEntry):
+        return item.path
+    return os.path.join(root, item)
+
+
+# template texts used to be imported here
+def __getattr__(name):
+    if name in templates.legacy_names:
+        return getattr(templates, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
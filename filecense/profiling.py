@@ -0,0 +1,119 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# profiles of whole runs, for --profile-out
+#
+# "cprofile" traces every call, also in threads started during the run such
+# as the --jobs pool, and writes a pstats file, read it with
+#   python -m pstats FILE
+# "sample" looks at the stacks of all threads every interval instead and
+# writes them in the collapsed format flame graph tools read, one
+# "outer;...;inner count" line per distinct stack, slower calls show up
+# in more samples while the run itself barely slows down
+
+import os
+import sys
+import threading
+from collections import Counter
+
+
+# calls func(*args) profiled with mode and writes the profile to path, also
+# when func raises
+def profile_call(func, args, path, mode="cprofile", interval=0.005):
+    if mode == "cprofile":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        threads = thread_profilers()
+        threading.setprofile(threads.start)
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            threading.setprofile(None)
+            pstats.Stats(profiler, *threads.profilers).dump_stats(path)
+    elif mode == "sample":
+        smplr = sampler(interval)
+        smplr.start()
+        try:
+            return func(*args)
+        finally:
+            smplr.stop()
+            smplr.dump(path)
+    else:
+        raise ValueError("unknown profile mode: %s" % mode)
+
+
+# gives every new thread its own cProfile profiler, started by the first
+# profile event of the thread, stats of all of them are merged at the end
+class thread_profilers:
+    def __init__(self):
+        self.profilers = []
+        self.lock = threading.Lock()
+
+    def start(self, frame, event, arg):
+        import cProfile
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return  # profiling is process wide, threads are already seen
+        with self.lock:
+            self.profilers.append(profiler)
+
+
+class sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[collapse(frame)] += 1
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+
+# "outer;...;inner" for the stack that ends in frame
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s (%s:%d)" % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
@@ -0,0 +1,86 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# machine readable outcome of every path, for --report
+#
+# records are written as they happen so memory use does not grow with the
+# tree, "jsonl" writes one object per line, "json" writes one array
+#
+#   {"path": "src/logo.png", "outcome": "ignored", "rule": ".*\\.png$",
+#    "dir": false}
+#   {"path": "src/main.go", "outcome": "cached"}
+#   {"path": "src/util.go", "outcome": "licensed", "syntax": ["//"],
+#    "bytes_written": 1520, "elapsed": 0.0004}
+#
+# outcomes are "ignored", "cached", "already_licensed", "licensed" and
+# "error", errors have an "error" message instead of "bytes_written", with
+# --check files without a license are "missing" and nothing is written
+
+import json
+
+formats = ["json", "jsonl"]
+
+
+class reporter:
+    def __init__(self, stream, fmt="jsonl"):
+        if fmt not in formats:
+            raise ValueError("unknown report format: %s" % fmt)
+        self.stream = stream
+        self.fmt = fmt
+        self.records = 0
+
+    def write(self, record):
+        line = json.dumps(record)
+        if self.fmt == "json":
+            line = ("[\n" if self.records == 0 else ",\n") + line
+        else:
+            line += "\n"
+        self.stream.write(line)
+        self.records += 1
+
+    def ignored(self, path, rule, is_dir):
+        self.write({"path": path, "outcome": "ignored", "rule": rule,
+                    "dir": is_dir})
+
+    def cached(self, path):
+        self.write({"path": path, "outcome": "cached"})
+
+    def licensed(self, path, licensed, syntax, written, elapsed):
+        self.write({"path": path,
+                    "outcome": "licensed" if licensed else "already_licensed",
+                    "syntax": syntax, "bytes_written": written,
+                    "elapsed": elapsed})
+
+    # result of --check, present tells if the file has the license
+    def checked(self, path, present, syntax, elapsed):
+        self.write({"path": path,
+                    "outcome": "already_licensed" if present else "missing",
+                    "syntax": syntax, "elapsed": elapsed})
+
+    def error(self, path, error, syntax, elapsed):
+        self.write({"path": path, "outcome": "error", "error": error,
+                    "syntax": syntax, "elapsed": elapsed})
+
+    # ends the json array, the stream is left open
+    def close(self):
+        if self.fmt == "json":
+            self.stream.write("[]\n" if self.records == 0 else "\n]\n")
+        self.stream.flush()
@@ -0,0 +1,132 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# wall time and counts per phase of a run, for --profile
+#
+# phases nest, time is charged to the innermost one only, so while the
+# licensing loop pulls the next file from the walk the walk is charged and
+# the phase times add up to the time of the whole run. a licenser given
+# the timer charges "detect" and "write" with the bytes it actually read
+# and wrote, which only works when files are licensed in the thread that
+# runs the timer
+
+import time
+
+
+class phase_stats:
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self.read = 0
+        self.written = 0
+
+
+class phase_timer:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.phases = {}
+        self.stack = []
+        self.last = clock()
+        self.started = self.last
+
+    def stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = phase_stats()
+        return self.phases[name]
+
+    # charges time since the last switch to the running phase
+    def switch(self):
+        now = self.clock()
+        if self.stack:
+            self.stats(self.stack[-1]).seconds += now - self.last
+        self.last = now
+
+    def enter(self, name):
+        self.switch()
+        self.stack.append(name)
+        self.stats(name)
+
+    def leave(self):
+        self.switch()
+        self.stack.pop()
+
+    # with timer.phase("name"): ...
+    def phase(self, name):
+        return _phase(self, name)
+
+    def count(self, name, files=0, read=0, written=0):
+        stats = self.stats(name)
+        stats.files += files
+        stats.read += read
+        stats.written += written
+
+    # yields items, time spent getting each one is charged to name and every
+    # item is counted as a file of it, or as count(item) files
+    def wrap(self, name, items, count=None):
+        items = iter(items)
+        stats = self.stats(name)
+        while True:
+            self.enter(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            stats.files += 1 if count is None else count(item)
+            yield item
+
+    # summary table, totals is a list of (label, count) for the last line
+    def summary(self, totals=()):
+        self.switch()
+        rows = ["%-12s %10s %10s %12s %14s %14s" % (
+            "phase", "seconds", "files", "files/sec", "bytes read",
+            "bytes written")]
+        total = phase_stats()
+        for name, stats in self.phases.items():
+            rows.append(row(name, stats))
+            total.files = max(total.files, stats.files)
+            total.read += stats.read
+            total.written += stats.written
+        total.seconds = self.last - self.started
+        rows.append(row("total", total))
+        if totals:
+            rows.append(", ".join("%s %d" % t for t in totals))
+        return "\n".join(rows)
+
+
+class _phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.enter(self.name)
+        return self.timer.stats(self.name)
+
+    def __exit__(self, *exc):
+        self.timer.leave()
+
+
+def row(name, stats):
+    rate = stats.files / stats.seconds if stats.seconds > 0 else 0.0
+    return "%-12s %10.3f %10d %12.1f %14d %14d" % (
+        name, stats.seconds, stats.files, rate, stats.read, stats.written)
@@ -0,0 +1,314 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# file discovery from git instead of walking the filesystem
+
+import os
+import struct
+
+
+# runs git in path and returns its output split on NUL
+def git(path, *args):
+    import subprocess
+    try:
+        proc = subprocess.run(["git", "-C", path] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError("git not found")
+    if proc.returncode != 0:
+        raise RuntimeError("git %s failed: %s" % (
+            args[0], proc.stderr.decode(errors="replace").strip()))
+    return [os.fsdecode(p) for p in proc.stdout.split(b"\0") if p]
+
+
+# paths below path, relative to it, that were added or modified since ref
+# in commits or the working tree, plus new untracked files
+def changed_files(path, ref):
+    changed = git(path, "diff", "--name-only", "-z", "--relative",
+                  "--diff-filter=AMR", ref, "--")
+    untracked = git(path, "ls-files", "-z", "--others", "--exclude-standard")
+    seen = set(changed)
+    return changed + [p for p in untracked if p not in seen]
+
+
+# paths below path, relative to it, of regular files tracked by git, read
+# from the index file when possible
+def tracked_files(path):
+    try:
+        return index_files(path)
+    except (OSError, ValueError, struct.error):
+        pass
+    res = []
+    last = None
+    for line in git(path, "ls-files", "-z", "--stage"):
+        info, name = line.split("\t", 1)  # "mode object stage\tpath"
+        if int(info.split(" ", 1)[0], 8) >> 12 == regular_file and \
+                name != last:
+            res.append(name)
+        last = name
+    return res
+
+
+def index_files(path):
+    top, git_dir = find_repo(path)
+    if top is None:
+        raise ValueError("not a git repository")
+    config = os.path.join(git_dir, "config")
+    if os.path.isfile(config):
+        with open(config, "rb") as f:
+            if b"sha256" in f.read().lower():
+                raise ValueError("only sha1 repositories are supported")
+    rel = os.path.relpath(os.path.abspath(path), top)
+    prefix = "" if rel == "." else rel.replace(os.sep, "/") + "/"
+    res = []
+    for name in read_index(os.path.join(git_dir, "index")):
+        if name.startswith(prefix):
+            res.append(name[len(prefix):])
+    return res
+
+
+# returns (worktree, git dir) of the repository path is in, or (None, None)
+def find_repo(path):
+    directory = os.path.abspath(path)
+    while True:
+        dotgit = os.path.join(directory, ".git")
+        if os.path.isdir(dotgit):
+            return directory, dotgit
+        if os.path.isfile(dotgit):  # worktrees and submodules
+            with open(dotgit) as f:
+                line = f.readline().strip()
+            if not line.startswith("gitdir: "):
+                raise ValueError("unknown .git file")
+            return directory, os.path.join(directory, line[len("gitdir: "):])
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None, None
+        directory = parent
+
+
+index_header = struct.Struct(">4sII")
+hash_size = 20
+mode_offset = 24
+flags_offset = 40 + hash_size
+name_offset = flags_offset + 2
+regular_file = 0o10  # object type bits of mode
+
+
+# yields paths of regular files in a git index file (versions 2 to 4) that
+# are checked out, each path once even with merge conflicts
+def read_index(index_path):
+    with open(index_path, "rb") as f:
+        data = f.read()
+    signature, version, count = index_header.unpack_from(data, 0)
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        raise ValueError("unsupported git index")
+    pos = index_header.size
+    prev = b""
+    last = None
+    names = []
+    for _ in range(count):
+        mode, = struct.unpack_from(">I", data, pos + mode_offset)
+        flags, = struct.unpack_from(">H", data, pos + flags_offset)
+        start = pos + name_offset
+        skip_worktree = False
+        if flags & 0x4000 and version >= 3:  # extended flags
+            extended, = struct.unpack_from(">H", data, start)
+            skip_worktree = extended & 0x4000
+            start += 2
+        if version == 4:  # path is compressed against the previous one
+            strip, start = varint(data, start)
+            end = data.index(b"\0", start)
+            name = prev[:len(prev) - strip] + data[start:end]
+            pos = end + 1
+        else:
+            end = data.index(b"\0", start)
+            name = data[start:end]
+            pos += (end - pos + 8) & ~7  # entries are padded with NULs
+        prev = name
+        if mode >> 12 != regular_file or skip_worktree or name == last:
+            continue
+        last = name
+        names.append(name)
+    # split and sparse indexes keep entries elsewhere
+    while pos + 8 <= len(data) - hash_size:
+        signature, size = struct.unpack_from(">4sI", data, pos)
+        if signature in (b"link", b"sdir"):
+            raise ValueError("split or sparse git index")
+        pos += 8 + size
+    return [os.fsdecode(name) for name in names]
+
+
+# git's offset encoding used by index version 4
+def varint(data, pos):
+    byte = data[pos]
+    value = byte & 0x7f
+    while byte & 0x80:
+        pos += 1
+        byte = data[pos]
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, pos + 1
+
+
+# .gitignore rules in effect for a directory, rules are compiled once per
+# file and shared by everything below it
+class gitignore:
+    def __init__(self, groups=()):
+        self.groups = groups
+
+    # returns matcher with rules from lines added, they apply to paths that
+    # start with base, matched as lead + the rest of the path
+    def child(self, base, lead, lines):
+        rules = [r for r in (parse_rule(line) for line in lines)
+                 if r is not None]
+        if not rules:
+            return self
+        return gitignore(self.groups + ((base, lead, rules),))
+
+    # path is as found by the walk and name its last part, the last
+    # matching rule decides
+    def ignored(self, path, name, is_dir):
+        for base, lead, rules in reversed(self.groups):
+            rel = None
+            for regex, negate, dir_only, basename in reversed(rules):
+                if dir_only and not is_dir:
+                    continue
+                if basename:
+                    target = name
+                else:
+                    if rel is None:
+                        rel = lead + path[len(base):].replace(os.sep, "/")
+                    target = rel
+                if regex.match(target) is not None:
+                    return not negate
+        return False
+
+
+# returns matcher with .git/info/exclude and .gitignore files of the
+# directories above path inside its repository. a single file is walked
+# as its own tree without its directory's .gitignore, so that one is read
+# here too and rules apply from the directory
+def load_gitignore(path):
+    matcher = gitignore()
+    single = os.path.isfile(path)
+    if single:
+        path = os.path.dirname(path)
+    top, git_dir = find_repo(path)
+    if top is None:
+        return matcher
+    base = os.path.join(path, "")
+    target = os.path.abspath(path)
+    sources = [(target, os.path.join(target, ".gitignore"))] if single \
+        else []
+    directory = target
+    while directory != top:
+        directory = os.path.dirname(directory)
+        sources.append((directory, os.path.join(directory, ".gitignore")))
+    sources.append((top, os.path.join(git_dir, "info", "exclude")))
+    for directory, name in reversed(sources):
+        rel = os.path.relpath(target, directory)
+        lead = "" if rel == "." else rel.replace(os.sep, "/") + "/"
+        matcher = matcher.child(base, lead, read_lines(name))
+    return matcher
+
+
+def read_lines(path):
+    try:
+        with open(path, encoding="utf-8", errors="surrogateescape") as f:
+            return f.read().splitlines()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return []
+
+
+# returns (regex, negate, dir_only, basename_only) for a .gitignore line,
+# None for blank lines and comments
+def parse_rule(line):
+    if line.startswith("#"):
+        return None
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "  # escaped trailing space
+    line = stripped
+    negate = line.startswith("!")
+    if negate or line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # patterns without a slash match a name at any depth
+    basename = "/" not in line
+    line = line.lstrip("/")
+    import re
+    return re.compile(translate(line)), negate, dir_only, basename
+
+
+# translates gitignore glob to a regex for "/" separated relative paths
+def translate(pattern):
+    import re
+    res = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            j = i
+            while j < n and pattern[j] == "*":
+                j += 1
+            whole = (i == 0 or pattern[i - 1] == "/") and \
+                (j == n or pattern[j] == "/")
+            if j - i == 2 and whole:
+                if j == n:
+                    res.append(".*")  # everything inside
+                    i = j
+                else:
+                    res.append("(?:.*/)?")  # any number of directories
+                    i = j + 1
+                continue
+            res.append("[^/]*")
+            i = j
+            continue
+        if c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j < n:
+                inner = pattern[i + 1:j]
+                if inner[0] in "!^":
+                    inner = "^" + inner[1:]
+                inner = inner.replace("[", "\\[")
+                res.append("(?!/)[" + inner + "]")
+                i = j + 1
+                continue
+            res.append("\\[")
+        elif c == "\\" and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return "".join(res) + r"\Z"
@@ -0,0 +1,278 @@
+#
+# Copyright 2020 Alexander Saastamoinen
+#
+#  Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+#  You may not use this work except in compliance with the
+# Licence.
+#  You may obtain a copy of the Licence at:
+#
+#  https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+#  Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+#  See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+#
+
+# licenses files as they are created or moved into a tree, for --watch
+#
+# directories are watched as the first walk reaches them, before they are
+# listed, so the tree is never walked again, new files are licensed once
+# they have not changed for the debounce time. linux inotify is used
+# through ctypes, elsewhere or when it fails the watched directories are
+# polled, a stat call per directory and a listing of the ones that changed.
+# directories inotify can't watch, e.g. past the watch limit, are polled
+# too. with --gitignore new entries get the rules of the directory they are
+# created in, .gitignore files that change while watching are not read
+# again
+
+import os
+import stat
+import struct
+import time
+
+poll_interval = 1.0  # seconds between polls without inotify
+_default = object()
+
+# inotify(7)
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_ONLYDIR = 0x1000000
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+event_header = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class inotify:
+    def __init__(self):
+        import ctypes
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # watch descriptor -> directory
+
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                         IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.dirs[wd] = directory
+
+    # returns (path, is_dir) of entries created or moved into watched
+    # directories, (None, True) if events were lost and all of it should be
+    # looked at again, waits up to timeout seconds, None waits until one
+    def read(self, timeout):
+        import select
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, True))
+            elif mask & IN_IGNORED:  # directory removed
+                self.dirs.pop(wd, None)
+            elif name and wd in self.dirs:
+                events.append((os.path.join(self.dirs[wd], os.fsdecode(name)),
+                               bool(mask & IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class poller:
+    def __init__(self, interval=poll_interval, sleep=time.sleep):
+        self.interval = interval
+        self.sleep = sleep
+        self.dirs = {}  # directory -> (mtime_ns, names)
+
+    # watches directory with the backend, or polls it if inotify can't
+    def add(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            names = set(os.listdir(directory))
+        except OSError:
+            return
+        self.dirs[directory] = (mtime, names)
+
+    # same as inotify.read, only directories with a new mtime are listed
+    def read(self, timeout):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        if timeout > 0:
+            self.sleep(timeout)
+        events = []
+        for directory, (mtime, names) in list(self.dirs.items()):
+            try:
+                now = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self.dirs[directory]
+                continue
+            if now == mtime:
+                continue
+            try:
+                with os.scandir(directory) as it:
+                    entries = {e.name: e for e in it}
+            except OSError:
+                continue
+            self.dirs[directory] = (now, set(entries))
+            for name in sorted(entries.keys() - names):
+                entry = entries[name]
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                events.append((entry.path, is_dir))
+        return events
+
+    def close(self):
+        pass
+
+
+# inotify where it works, otherwise polling
+def default_backend():
+    try:
+        return inotify()
+    except (OSError, AttributeError, TypeError):
+        return poller()
+
+
+class watch:
+    def __init__(self, fndr, func, debounce=0.5, backend=None,
+                 clock=time.monotonic):
+        self.finder = fndr
+        self.func = func
+        self.debounce = debounce
+        self.backend = backend if backend is not None else default_backend()
+        self.clock = clock
+        self.root = None
+        self.pending = {}  # path -> ((size, mtime), time it was last seen)
+        self.settled = {}  # path -> (size, mtime) after func handled it
+        self.fallback = None  # poller for directories backend can't watch
+        fndr.matchers = {}  # .gitignore rules of watched directories
+
+    # walks like finder.find_files and watches every directory the walk
+    # reaches, pass it through finder.ignore to get the files
+    def walk(self, path):
+        if self.root is None:
+            self.root = path
+        return self.finder.find_files(path, self.add)
+
+    # watches directory with the backend, or polls it if inotify can't
+    def add(self, directory):
+        try:
+            self.backend.add(directory)
+        except OSError as e:
+            if isinstance(self.backend, poller):
+                print("can't watch ", directory, ": ", e.strerror)
+                return
+            if self.fallback is None:
+                print("can't watch ", directory, ": ", e.strerror,
+                      ", polling it and others that fail")
+                self.fallback = poller()
+            self.fallback.add(directory)
+
+    # handles events for up to timeout seconds, by default until something
+    # happens or a pending file may be due, returns (path, func(path)) of
+    # files that have not changed for the debounce time
+    def poll_once(self, timeout=_default):
+        if timeout is _default:
+            timeout = self.debounce if self.pending else None
+        if self.fallback is None:
+            events = self.backend.read(timeout)
+        else:
+            if timeout is None or timeout > self.fallback.interval:
+                timeout = self.fallback.interval
+            events = self.backend.read(timeout) + self.fallback.read(0)
+        for path, is_dir in events:
+            if path is None:  # events lost, look at everything again
+                self.add_tree(self.root)
+                continue
+            if not self.kept(path, is_dir):
+                continue
+            if is_dir:
+                self.add_tree(path)
+            else:
+                self.pending.setdefault(path, (None, self.clock()))
+        return self.due()
+
+    # True if the walk would not have ignored a new entry, .gitignore rules
+    # come from the directory it was created in
+    def kept(self, path, is_dir):
+        parent, name = os.path.split(path)
+        items = [name]
+        self.finder.ignoreItems(is_dir, items, parent)
+        if items and self.finder.gitignore is not None:
+            self.finder.gitignores[parent] = self.finder.matchers.get(
+                parent, self.finder.gitignore)
+            if is_dir:
+                self.finder.ignoreGit(parent, items, [], False)
+            else:
+                self.finder.ignoreGit(parent, [], items, False)
+        return bool(items)
+
+    def add_tree(self, path):
+        for f in self.finder.ignore(self.walk(path)):
+            self.pending.setdefault(f, (None, self.clock()))
+
+    def due(self):
+        now = self.clock()
+        done = []
+        for path, (seen, since) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:  # gone again, e.g. a temporary file
+                del self.pending[path]
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                del self.pending[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != seen:
+                self.pending[path] = (current, now)
+                continue
+            if now - since < self.debounce:
+                continue
+            del self.pending[path]
+            if self.settled.pop(path, None) == current:
+                continue  # our own rename of a file that was just licensed
+            res = self.func(path)
+            try:
+                st = os.stat(path)
+                self.settled[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+            done.append((path, res))
+        return done
+
+    # calls handle(path, func(path)) for new files until interrupted
+    def run(self, handle):
+        try:
+            while True:
+                for path, res in self.poll_once():
+                    handle(path, res)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.backend.close()
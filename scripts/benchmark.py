@@ -0,0 +1,222 @@
+from filecense.logic import finder, ignore_items, file_format, licenser
+from filecense.logic import const_ignore_dirs, const_ignore_files
+from filecense.logic import already_has_license, write_top, find_root
+from filecense.logic import license
+import argparse
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+# names for a single wide directory, every third one is ignored
+def wide_dir(width):
+    exts = ["go", "png", "py"]
+    return ["file%d.%s" % (i, exts[i % 3]) for i in range(width)]
+
+
+def bench_ignore_items(widths, repeat):
+    fndr = finder(False, ignore_items(const_ignore_dirs),
+                  ignore_items(const_ignore_files))
+    print("finder.ignoreItems on wide directories")
+    print("%10s %12s %14s" % ("entries", "seconds", "ns per entry"))
+    for width in widths:
+        names = wide_dir(width)
+        best = None
+        for _ in range(repeat):
+            items = list(names)
+            start = time.perf_counter()
+            fndr.ignoreItems(False, items)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print("%10d %12.4f %14.1f" % (width, best, best / width * 1e9))
+
+
+# "go:5" -> ("go", 5), the weight defaults to 1
+def ext_weight(arg):
+    ext, _, weight = arg.partition(":")
+    return ext, float(weight or 1)
+
+
+# directories of a tree where every directory above depth has fanout
+# children, relative to its root
+def tree_dirs(depth, fanout):
+    dirs = [""]
+    level = [""]
+    for d in range(depth):
+        level = [os.path.join(parent, "dir%d_%d" % (d, i))
+                 for parent in level for i in range(fanout)]
+        dirs += level
+    return dirs
+
+
+# writes a tree in root, the same arguments always give the same tree,
+# file sizes are log-normal around size, licensed is the fraction of
+# source files that start with the header already, returns created paths
+def generate_tree(root, files, depth, fanout, size, spread, exts, licensed,
+                  seed, lcnsr):
+    rand = random.Random(seed)
+    dirs = tree_dirs(depth, fanout)
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    names = [e for e, _ in exts]
+    weights = [w for _, w in exts]
+    line = b"x = 1  # synthetic source line for benchmarking filecense\n"
+    paths = []
+    for i in range(files):
+        ext = rand.choices(names, weights)[0]
+        path = os.path.join(root, rand.choice(dirs), "file%d.%s" % (i, ext))
+        length = int(rand.lognormvariate(math.log(size), spread))
+        body = (line * (length // len(line) + 1))[:length]
+        with open(path, "wb") as f:
+            if rand.random() < licensed:
+                try:
+                    f.write(lcnsr.header(path)[1])
+                except (KeyError, ValueError):
+                    pass  # no comment syntax, filecense skips these
+            f.write(body)
+        paths.append(path)
+    return paths
+
+
+def syntax_or_none(formats, path):
+    try:
+        return formats.comment_syntax(path)
+    except (KeyError, ValueError):
+        return None
+
+
+# best time of repeat runs of func()
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(stage, items, seconds):
+    per_item = seconds / items * 1e6 if items else 0.0
+    print("%-28s %10d %12.4f %14.2f" % (stage, items, seconds, per_item))
+
+
+def bench_tree(args):
+    formats = file_format()
+    lcnsr = licenser(license[args.license].header, formats, "", 2020,
+                     "Benchmark Holder")
+    root = args.keep or tempfile.mkdtemp(prefix="filecense-bench-")
+    try:
+        start = time.perf_counter()
+        generate_tree(root, args.files, args.depth, args.fanout, args.size,
+                      args.spread, args.exts, args.licensed, args.seed,
+                      lcnsr)
+        print("generated %d files in %d directories under %s in %.2fs" % (
+            args.files, len(tree_dirs(args.depth, args.fanout)), root,
+            time.perf_counter() - start))
+        print("%-28s %10s %12s %14s" % ("stage", "items", "seconds",
+                                         "us per item"))
+
+        def new_finder():
+            return finder(False, ignore_items(const_ignore_dirs),
+                          ignore_items(const_ignore_files))
+
+        found = []
+
+        def get_files():
+            found[:] = new_finder().get_files(root)
+        seconds = best_of(args.repeat, get_files)
+        report("finder.get_files", len(found), seconds)
+
+        names = []
+        for _, dirs, files in os.walk(root):
+            names += dirs + files
+        ignores = ignore_items(const_ignore_files)
+        report("ignore_items.ignore", len(names),
+               best_of(args.repeat,
+                       lambda: [ignores.ignore(n) for n in names]))
+
+        report("file_format.comment_syntax", len(found),
+               best_of(args.repeat,
+                       lambda: [syntax_or_none(formats, p) for p in found]))
+
+        # files neither ignored nor supported are skipped by filecense too
+        found = [p for p in found if syntax_or_none(formats, p) is not None]
+
+        tops = [(p, lcnsr.header(p)[1]) for p in found]
+        report("already_has_license", len(tops),
+               best_of(args.repeat,
+                       lambda: [already_has_license(p, t) for p, t in tops]))
+
+        missing = [(p, t) for p, t in tops if not already_has_license(p, t)]
+        start = time.perf_counter()
+        for p, t in missing:
+            write_top(t, p)
+        report("write_top", len(missing), time.perf_counter() - start)
+
+        report("find_root", 1,
+               best_of(args.repeat, lambda: find_root(root)))
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--suite",
+                        help="Benchmarks to run",
+                        choices=["wide", "tree", "all"], default="all")
+    parser.add_argument("-w", "--widths",
+                        help="Directory sizes to benchmark",
+                        type=int, nargs="+",
+                        default=[25000, 50000, 100000, 200000])
+    parser.add_argument("-r", "--repeat",
+                        help="Runs per size, best is reported",
+                        type=int, default=3)
+    parser.add_argument("-n", "--files",
+                        help="Files in the synthetic tree",
+                        type=int, default=5000)
+    parser.add_argument("--depth",
+                        help="Directory levels below the root",
+                        type=int, default=3)
+    parser.add_argument("--fanout",
+                        help="Subdirectories per directory",
+                        type=int, default=4)
+    parser.add_argument("--size",
+                        help="Median file size in bytes",
+                        type=int, default=4096)
+    parser.add_argument("--spread",
+                        help="Sigma of the log-normal file size distribution",
+                        type=float, default=1.0)
+    parser.add_argument("--exts",
+                        help="Extension mix as ext:weight, ignored "
+                        "extensions and ones without a comment syntax are "
+                        "walked but not licensed",
+                        type=ext_weight, nargs="+",
+                        default=[("py", 4), ("go", 3), ("js", 3), ("c", 2),
+                                 ("html", 1), ("png", 1), ("json", 1)])
+    parser.add_argument("--licensed",
+                        help="Fraction of files that already have a header",
+                        type=float, default=0.5)
+    parser.add_argument("--seed",
+                        help="Seed of the tree generator",
+                        type=int, default=0)
+    parser.add_argument("-l", "--license",
+                        help="License whose header is used",
+                        default="eupl")
+    parser.add_argument("--keep",
+                        help="Generate the tree in this directory and keep it")
+    args = parser.parse_args()
+    if args.suite in ("wide", "all"):
+        bench_ignore_items(args.widths, args.repeat)
+    if args.suite in ("tree", "all"):
+        bench_tree(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,7 @@ setup(
         name='filecense',
         version='0.1',
         packages=find_packages(),
+        package_data={"filecense": ["licenses/*.txt"]},
         author="miscing",
         author_email="miscing-public@pm.me",
         description="Adds a license to a project.",
@@ -48,5 +49,5 @@ setup(
             "License :: OSI Approved :: European Union Public Licence 1.2 (EUPL 1.2)",
             "Operating System :: OS Independent",
             ],
-        python_requires='>=3.6',
+        python_requires='>=3.7',
         )
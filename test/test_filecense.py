@@ -24,10 +24,35 @@ from filecense.logic import finder, ignore_items, file_format, find_root
 from filecense.logic import already_has_license, euplTop, parser
 from filecense.logic import const_ignore_files, const_ignore_dirs
 from filecense.logic import write_full, write_top, syntax_arg, comment_out
+from filecense.logic import licenser, execute, execute_processes
+from filecense.logic import implementation_details, header_cache
+from filecense.logic import license_file, mmap_threshold, has_git
+from filecense.aio import license_tree
+from filecense.cache import license_cache
+from filecense.templates import template, template_registry
+from filecense import templates
+from filecense.logic import stale_files, run, _run, outcome
+from filecense.report import reporter
+from filecense.watch import watch, poller, inotify
+from filecense.timing import phase_timer
+from filecense.profiling import profile_call
+from filecense.vcs import changed_files, tracked_files, read_index
+import io
+import json
+import mmap
+import pstats
+import subprocess
+import time
+import sys
+import tempfile
+from collections import Counter
+import asyncio
 import os
+import errno
 import glob
 from datetime import datetime
 from shutil import copyfile
+from unittest import mock
 
 here = os.path.dirname(os.path.realpath(__file__))
 
@@ -146,6 +171,25 @@ class TestIgnoreItems(unittest.TestCase):
         self.assertTrue(ignorefiles.ignore("picture.jpg"))
         self.assertTrue(ignorefiles.ignore("data.json"))
 
+    def test_compiled_matcher(self):
+        ignorefiles = ignore_items(const_ignore_files)
+        names = testfiles + ["go.sum", "go.mod", "a.yaml", "x.xml", "b.go"]
+        for name in names:
+            expected = any(ignorefiles[k](k, name) for k in ignorefiles)
+            self.assertEqual(ignorefiles.ignore(name), expected)
+        simple, regexes, others = ignorefiles.matcher
+        self.assertEqual(len(regexes), 1)
+        self.assertIn("go.sum", simple)
+        self.assertFalse(ignorefiles.ignore("aa.go"))
+        ignorefiles.set_regex(r"^(\w)\1\.go$")
+        ignorefiles.set_simple("b.go")
+        self.assertTrue(ignorefiles.ignore("aa.go"))
+        self.assertFalse(ignorefiles.ignore("ab.go"))
+        self.assertTrue(ignorefiles.ignore("b.go"))
+        self.assertEqual(ignorefiles.rule("b.go"), "b.go")
+        self.assertEqual(ignorefiles.rule("aa.go"), r"^(\w)\1\.go$")
+        self.assertIsNone(ignorefiles.rule("ab.go"))
+
 
 class TestFinder(unittest.TestCase):
     @classmethod
@@ -160,7 +204,8 @@ class TestFinder(unittest.TestCase):
             self.assertTrue(validDir(os.path.normpath(root)))
             self.assertEqual(len(files), len(testfiles))
             for f in files:
-                self.assertTrue(validFile(f))
+                self.assertTrue(validFile(f.name))
+                self.assertTrue(f.is_file())
 
     def test_ignoreItems(self):
         all_files = self.finder.find_files("./testdata/")
@@ -176,21 +221,61 @@ class TestFinder(unittest.TestCase):
                  ]
         for _, d, _ in all_files:
             self.finder.ignoreItems(True, d)
-            self.assertEqual(['newdir'], d)
+            self.assertEqual(['newdir'], [e.name for e in d])
             break
         for _, _, f in all_files:
             self.finder.ignoreItems(False, f)
-            self.assertEqual(trimmedFiles.sort(), f.sort())
+            self.assertEqual(sorted(trimmedFiles), sorted(e.name for e in f))
             break
+        names = list(testfiles)
+        self.finder.ignoreItems(False, names)
+        self.assertEqual(sorted(trimmedFiles), sorted(names))
 
     def test_ignore(self):
         all_files = self.finder.find_files("./testdata/")
         files_after_ignore = self.finder.ignore(all_files)
-        self.assertEqual(notIgnoredFiles.sort(), files_after_ignore.sort())
+        self.assertEqual(sorted(notIgnoredFiles), sorted(files_after_ignore))
 
     def test_get_files(self):
         files = self.finder.get_files("./testdata/")
-        self.assertEqual(notIgnoredFiles.sort(), files.sort())
+        first = next(files)
+        self.assertIn(first, notIgnoredFiles)
+        self.assertEqual(sorted(notIgnoredFiles),
+                         sorted([first] + list(files)))
+
+    def test_find_files_matches_os_walk(self):
+        walked = [(root, sorted(d), sorted(f))
+                  for root, d, f in os.walk("./testdata/")]
+        scanned = [(root, sorted(e.name for e in d), sorted(e.name for e in f))
+                   for root, d, f in self.finder.find_files("./testdata/")]
+        self.assertEqual(walked, scanned)
+
+    def test_get_entries(self):
+        entries = list(self.finder.get_entries("./testdata/"))
+        self.assertTrue(all(isinstance(e, os.DirEntry) for e in entries))
+        self.assertEqual(sorted(notIgnoredFiles),
+                         sorted(e.path for e in entries))
+
+    def test_single_file(self):
+        path = "./testdata/sourceFile.c"
+        self.assertEqual(list(self.finder.get_entries(path)), [path])
+        self.assertEqual(list(self.finder.get_files(path)), [path])
+        self.assertEqual(list(self.finder.get_files("./testdata/binFile")),
+                         [])
+
+    def test_filter_paths(self):
+        paths = [os.path.relpath(p, "./testdata/") for p in notIgnoredFiles]
+        paths += ["README.md", "newdir/binFile", ".hiddenDir/sourceFile.c",
+                  "newdir/node_modules/a.js", "testdata/sourceFile.go"]
+        self.assertEqual(
+                list(self.finder.filter_paths("./testdata/", paths)),
+                [os.path.join("./testdata/", p) for p in paths[:-5]])
+
+    def test_confirm_continue_force(self):
+        i_details = implementation_details(False, False, True)
+        files = self.finder.get_files("./testdata/")
+        files = i_details.confirm_continue(files)
+        self.assertEqual(sorted(notIgnoredFiles), sorted(files))
 
 
 class TestFileFormat(unittest.TestCase):
@@ -300,6 +385,91 @@ and then the end
         self.assertTrue(already_has_license(self.dst_path, top))
         os.remove(self.dst_path)
 
+    def test_already_has_license_prefix(self):
+        top = comment_out(euplTop, ["#"]) % (2020, "John Doe")
+        data = top.encode("utf-8")
+        cases = [
+                (data + b"\xff" * 100000, True),
+                (b"#!/usr/bin/env python3\n" + data + b"x = 1\n", True),
+                (b"#!/" + b"a" * 10000 + b"\n" + data, True),
+                (data.replace(b"\n", b"\r\n") + b"x = 1\r\n", True),
+                (data[:-10], False),
+                (b"#!/bin/sh", False),
+                (b"", False),
+                (b"x = 1\n" + data, False),
+                ]
+        for content, expected in cases:
+            with open(self.dst_path, "wb") as f:
+                f.write(content)
+            self.assertEqual(already_has_license(self.dst_path, top),
+                             expected)
+            self.assertEqual(already_has_license(self.dst_path, data),
+                             expected)
+        os.remove(self.dst_path)
+
+    def test_license_file(self):
+        top = (comment_out(euplTop, ["#"]) % (2020, "John Doe")).encode()
+        contents = [
+                b"x = 1\n" * 1000,
+                b"#!/usr/bin/env python3\nx = 1\n",
+                b"#!/" + b"a" * 20000 + b"\nx = 1\n",
+                b"#!/bin/sh",
+                b"#!/\nx = 1\n",
+                b"",
+                top + b"x = 1\n",
+                b"#!/bin/sh\n" + top.replace(b"\n", b"\r\n"),
+                ]
+        for content in contents:
+            with open(self.dst_path, "wb") as f:
+                f.write(content)
+            expected = not already_has_license(self.dst_path, top)
+            if expected:
+                write_top(top, self.dst_path)
+            with open(self.dst_path, "rb") as f:
+                expected_content = f.read()
+            # 1 maps every non empty file
+            for threshold in [mmap_threshold, 1]:
+                with open(self.dst_path, "wb") as f:
+                    f.write(content)
+                self.assertEqual(license_file(self.dst_path, top,
+                                              mmap_threshold=threshold),
+                                 expected)
+                with open(self.dst_path, "rb") as f:
+                    self.assertEqual(f.read(), expected_content)
+                self.assertFalse(license_file(self.dst_path, top,
+                                              mmap_threshold=threshold))
+        os.remove(self.dst_path)
+
+    def test_write_top_mapped(self):
+        with open(self.src_path, "rb") as f:
+            src_content = f.read()
+        copyfile(self.src_path, self.dst_path)
+        with mock.patch("filecense.logic.mmap_threshold", 1), \
+                mock.patch("mmap.mmap", wraps=mmap.mmap) as mapped:
+            write_top("// header\n", self.dst_path)
+        self.assertTrue(mapped.called)
+        with open(self.dst_path, "rb") as f:
+            self.assertEqual(f.read(), b"// header\n\n" + src_content)
+        os.remove(self.dst_path)
+
+    def test_license_file_threshold(self):
+        # longer than the first read, so the rest is copied
+        src_content = b"x = 1\n" * 2000
+        # the licenser's threshold is used all the way down, not the default
+        for threshold, maps in [(0, False), (len(src_content) + 1, False),
+                                (1, True)]:
+            with open(self.dst_path, "wb") as f:
+                f.write(src_content)
+            with mock.patch("filecense.logic.mmap_threshold", 1), \
+                    mock.patch("mmap.mmap", wraps=mmap.mmap) as mapped:
+                lcnsr = licenser(euplTop, file_format(), "", 2020, "John",
+                                 threshold)
+                self.assertTrue(lcnsr(self.dst_path))
+            self.assertEqual(mapped.called, maps)
+            with open(self.dst_path, "rb") as f:
+                self.assertTrue(f.read().endswith(src_content))
+        os.remove(self.dst_path)
+
     def test_write_top(self):
         with open(self.src_path) as f:
             src_content = f.read()
@@ -321,12 +491,471 @@ and then the end
                          self.euplCommented % (date, name)+src_content)
         os.remove(self.dst_path)
 
+    def test_header_cache(self):
+        cache = header_cache()
+        text, data = cache.get(euplTop, ["//"], 2020, "John Doe")
+        self.assertEqual(text + "\n", self.euplCommented % (2020, "John Doe"))
+        self.assertEqual(data, text.encode("utf-8"))
+        self.assertIs(cache.get(euplTop, ("//",), 2020, "John Doe")[0], text)
+        self.assertEqual(len(cache.data), 1)
+        cache.get(euplTop, ["#"], 2020, "John Doe")
+        cache.get(euplTop, ["//"], 2021, "John Doe")
+        self.assertEqual(len(cache.data), 3)
+        # every licenser has its own cache, nothing outlives it
+        lcnsr = licenser(euplTop, file_format(), "", 2020, "John Doe")
+        lcnsr.header("file.go")
+        other = licenser(euplTop, file_format(), "", 2020, "Jane Doe")
+        other.header("file.go")
+        self.assertEqual(len(lcnsr.headers.data), 1)
+        self.assertEqual(len(other.headers.data), 1)
+
+    def test_licenser_comment(self):
+        lcnsr = licenser(euplTop, file_format(), "<!--,-->", 2020, "John")
+        self.assertEqual(lcnsr.syntax("file.go"), ["<!--", "-->"])
+        lcnsr = licenser(euplTop, file_format(), "", 2020, "John")
+        self.assertEqual(lcnsr.syntax("file.go"), ["//"])
+
+    def test_write_top_atomic(self):
+        copyfile(self.src_path, self.dst_path)
+        os.chmod(self.dst_path, 0o751)
+        with open(self.src_path, "rb") as f:
+            src_content = f.read()
+        with mock.patch("shutil.copyfileobj",
+                        side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                write_top("// header\n", self.dst_path)
+        with open(self.dst_path, "rb") as f:
+            self.assertEqual(f.read(), src_content)
+        self.assertEqual(glob.glob(".test_file_should_not_exist*"), [])
+        link = "test_link_should_not_exist.go"
+        os.symlink(self.dst_path, link)
+        write_top("// header\n", link)
+        self.assertTrue(os.path.islink(link))
+        with open(self.dst_path, "rb") as f:
+            self.assertEqual(f.read(), b"// header\n\n" + src_content)
+        self.assertEqual(os.stat(self.dst_path).st_mode & 0o777, 0o751)
+        os.remove(link)
+        os.remove(self.dst_path)
+
+    def test_write_top_keeps_file(self):
+        with open(self.src_path, "rb") as f:
+            src_content = f.read()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "main.go")
+            other = os.path.join(d, "other.go")
+            copyfile(self.src_path, path)
+            os.link(path, other)
+            with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+                self.assertTrue(license_file(path, "// header\n"))
+            self.assertTrue(fsync.called)
+            # both links keep sharing the licensed file
+            self.assertEqual(os.stat(path).st_nlink, 2)
+            with open(other, "rb") as f:
+                self.assertEqual(f.read(), b"// header\n\n" + src_content)
+            os.remove(other)
+            # a directory that can't be written gets the file written over
+            ino = os.stat(path).st_ino
+            with mock.patch("os.access", return_value=False):
+                write_top("// top\n", path)
+            self.assertEqual(os.stat(path).st_ino, ino)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"// top\n\n// header\n\n" +
+                                 src_content)
+            self.assertEqual(os.listdir(d), ["main.go"])
+            if hasattr(os, "geteuid") and os.geteuid() == 0:
+                os.chown(path, 1000, 1000)
+                license_file(path, "// owner\n")
+                st = os.stat(path)
+                self.assertEqual((st.st_uid, st.st_gid), (1000, 1000))
+
     def test_comment_out(self):
         for s, ht in self.syntax_and_hardcoded_text:
             commented = comment_out(self.uncommented, s)
             self.assertEqual(commented, ht)
 
 
+source_names = ["sourceFile.c", "sourceFile.go", "sourceFile.py",
+                "sourceFile.html", "sourceFile.css"]
+
+
+# copies source_names from testdata into directory, returns their paths
+def copy_sources(directory):
+    src_dir = os.path.normpath(os.path.join(here, "../testdata"))
+    paths = []
+    for name in source_names:
+        path = os.path.join(directory, name)
+        copyfile(os.path.join(src_dir, name), path)
+        paths.append(path)
+    return paths
+
+
+class TestExecute(unittest.TestCase):
+    def setUp(self):
+        self.dst_dir = "test_dir_should_not_exist"
+        os.mkdir(self.dst_dir)
+        self.paths = copy_sources(self.dst_dir)
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+        os.rmdir(self.dst_dir)
+
+    def test_execute_order(self):
+        for jobs in [1, 4]:
+            res = list(execute(lambda x: x * 2, iter(range(50)), jobs))
+            self.assertEqual(res, [(x, x * 2) for x in range(50)])
+
+    def test_jobs_match_serial(self):
+        lcnsr = licenser(euplTop, file_format(), "", 2020, "John Doe")
+        self.assertEqual(list(execute(lcnsr, self.paths, 4)),
+                         [(p, True) for p in self.paths])
+        self.assertEqual(list(execute(lcnsr, self.paths, 1)),
+                         [(p, False) for p in self.paths])
+        for path in self.paths:
+            self.assertTrue(already_has_license(path, lcnsr.top(path)))
+
+    def test_processes_match_serial(self):
+        lcnsr = licenser(euplTop, file_format(), "", 2020, "John Doe")
+        counters = Counter()
+        res = list(execute_processes(lcnsr, iter(self.paths), 2, counters,
+                                     chunksize=2))
+        self.assertEqual(res, [(p, True) for p in self.paths])
+        self.assertEqual(counters, Counter({True: len(self.paths)}))
+        counters = Counter()
+        res = list(execute(lcnsr, self.paths, 1, counters))
+        self.assertEqual(res, [(p, False) for p in self.paths])
+        self.assertEqual(counters, Counter({False: len(self.paths)}))
+
+    def test_outcome_counters(self):
+        weird = os.path.join(self.dst_dir, "file.weird")
+        with open(weird, "w") as f:
+            f.write("text\n")
+        self.paths.append(weird)
+        work = outcome(licenser(euplTop, file_format(), "", 2020, "John"))
+        counters = Counter()
+        list(execute_processes(work, self.paths, 2, counters, chunksize=2))
+        self.assertEqual(counters, Counter({True: len(self.paths) - 1,
+                                            "error": 1}))
+        for jobs in [1, 4]:
+            counters = Counter()
+            list(execute(work, self.paths, jobs, counters))
+            self.assertEqual(counters, Counter({False: len(self.paths) - 1,
+                                                "error": 1}))
+
+    def test_license_tree(self):
+        async def run():
+            seen = []
+            async for path, result, error in license_tree(
+                    self.dst_dir, "John", date=2020, concurrency=2):
+                seen.append((path, result, error))
+            counters = await license_tree(self.dst_dir, "John", date=2020)
+            return seen, counters
+        seen, counters = asyncio.run(run())
+        self.assertEqual(sorted(seen),
+                         sorted((p, "licensed", None) for p in self.paths))
+        self.assertEqual(counters,
+                         Counter({"already_licensed": len(self.paths)}))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir,
+                                                     "LICENSE")))
+        with self.assertRaises(ValueError):
+            license_tree(self.dst_dir, "John", "notalicense")
+
+    def test_license_tree_errors(self):
+        weird = os.path.join(self.dst_dir, "file.weird")
+        with open(weird, "w") as f:
+            f.write("text\n")
+        self.paths.append(weird)
+        skipped = os.path.join(self.dst_dir, "sourceFile.css")
+
+        async def run():
+            seen = {}
+            async for path, result, error in license_tree(
+                    self.dst_dir, "John", date=2020,
+                    skip_files=["sourceFile.css", (r"\.html$", "regex")]):
+                seen[path] = (result, error)
+            return seen
+        seen = asyncio.run(run())
+        result, error = seen.pop(weird)
+        self.assertEqual(result, "error")
+        self.assertIsInstance(error, str)
+        self.assertNotIn(skipped, seen)
+        self.assertEqual(set(seen.values()), {("licensed", None)})
+        self.assertEqual(len(seen), len(self.paths) - 3)
+        counters = asyncio.run(license_tree(self.dst_dir, "John", date=2020)
+                               .collect())
+        self.assertEqual(counters["error"], 1)
+
+    def test_cache(self):
+        cache_path = os.path.join(self.dst_dir, ".filecense-cache")
+        lcnsr = licenser(euplTop, file_format(), "", 2020, "John Doe")
+        cache = license_cache(cache_path)
+        skipped = []
+        self.assertEqual(list(stale_files(self.paths, cache, lcnsr,
+                                          skipped.append)), self.paths)
+        for path, _ in execute(lcnsr, self.paths):
+            cache.record(path, os.stat(path), lcnsr.header(path)[1])
+        cache.save()
+        self.paths.append(cache_path)  # removed on teardown
+        cache = license_cache(cache_path)
+        self.assertEqual(list(stale_files(self.paths[:-1], cache, lcnsr,
+                                          skipped.append)), [])
+        self.assertEqual(skipped, self.paths[:-1])
+        # changed file or header makes an entry stale
+        with open(self.paths[0], "a") as f:
+            f.write("\n")
+        self.assertEqual(list(stale_files(self.paths[:-1], cache, lcnsr,
+                                          skipped.append)), self.paths[:1])
+        lcnsr = licenser(euplTop, file_format(), "", 2021, "John Doe")
+        self.assertEqual(list(stale_files(self.paths[:-1], cache, lcnsr,
+                                          skipped.append)), self.paths[:-1])
+        # the same files spelled another way hit the same entries
+        lcnsr = licenser(euplTop, file_format(), "", 2020, "John Doe")
+        for path, _ in execute(lcnsr, self.paths[:-1]):
+            cache.record(path, os.stat(path), lcnsr.header(path)[1])
+        other = [os.path.join(".", p) for p in self.paths[:-1]]
+        other[1] = os.path.abspath(other[1])
+        cache.seen.clear()
+        self.assertEqual(list(stale_files(other, cache, lcnsr,
+                                          skipped.append)), [])
+        cache.save(prune=True)
+        self.assertEqual(len(license_cache(cache_path).data), len(other))
+        with open(cache_path, "wb") as f:
+            f.write(b"FLC1garbage")
+        self.assertEqual(license_cache(cache_path).data, {})
+
+    def test_execute_closed_early(self):
+        calls = []
+
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.01)
+            return x
+
+        results = execute(slow, range(1000), 4)
+        self.assertEqual(next(results), (0, 0))
+        results.close()
+        self.assertLessEqual(len(calls), 4 * 2 + 4)
+
+    def test_jobs_flag(self):
+        self.assertEqual(parser().parse_args([]).jobs, 1)
+        self.assertEqual(parser().parse_args(["-j", "8"]).jobs, 8)
+        self.assertEqual(parser().parse_args(["-P", "4"]).processes, 4)
+        self.assertIsNone(parser().parse_args([]).cache)
+        self.assertEqual(parser().parse_args(["--cache", "-e"]).cache, "")
+        self.assertEqual(parser().parse_args([]).source, "walk")
+        self.assertTrue(parser().parse_args(["-gi"]).gitignore)
+
+
+# runs of the command line on a temporary copy of the sources
+class RunTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = self.tmpdir.name
+        self.paths = copy_sources(self.tmp)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    # a file with no known comment syntax, licensing it fails
+    def add_weird(self):
+        with open(os.path.join(self.tmp, "file.weird"), "w") as f:
+            f.write("text\n")
+
+
+class TestCheck(RunTestCase):
+    def test_check(self):
+        flags = ["-p", self.tmp, "-d", "2020", "-j", "2", "--check"]
+        names = sorted(os.listdir(self.tmp))
+        with mock.patch("builtins.print") as printed:
+            self.assertEqual(run(parser().parse_args(
+                flags + ["-e", "John Doe"])), 1)
+        self.assertEqual(printed.call_count, 1)
+        with mock.patch("builtins.print"):
+            self.assertEqual(run(parser().parse_args(
+                flags + ["all", "John Doe"])), len(self.paths))
+        self.assertEqual(sorted(os.listdir(self.tmp)), names)
+        with open(os.path.join(self.tmp, "sourceFile.go"), "rb") as f:
+            self.assertFalse(f.read().startswith(b"//"))
+        with mock.patch("builtins.print"):
+            run(parser().parse_args(["-f", "-p", self.tmp, "-d", "2020",
+                                     "John Doe"]))
+            self.assertEqual(run(parser().parse_args(
+                flags + ["all", "John Doe"])), 0)
+        args = parser().parse_args(["--check", "-e"])
+        self.assertEqual(args.check, "first")
+        self.assertIsNone(parser().parse_args([]).check)
+
+
+class TestReport(RunTestCase):
+    def test_report(self):
+        self.add_weird()
+        report_path = os.path.join(self.tmp, "report.json")
+        args = parser().parse_args(["-f", "-p", self.tmp, "-d", "2020",
+                                    "--report", "json", "--report-file",
+                                    report_path, "John Doe"])
+        with mock.patch("builtins.print"):
+            self.assertEqual(run(args), 1)
+        with open(report_path) as f:
+            records = {os.path.basename(r["path"]): r for r in json.load(f)}
+        self.assertEqual(records["file.weird"]["outcome"], "error")
+        self.assertIsNone(records["file.weird"]["syntax"])
+        go = records["sourceFile.go"]
+        self.assertEqual(go["outcome"], "licensed")
+        self.assertEqual(go["syntax"], ["//"])
+        self.assertEqual(go["bytes_written"], os.path.getsize(go["path"]))
+        self.assertEqual(records["report.json"]["outcome"], "ignored")
+        self.assertEqual(records["report.json"]["rule"], r"^.+\.json$")
+        # files already licensed are reported as such, one per line
+        stream = io.StringIO()
+        rep = reporter(stream, "jsonl")
+        with mock.patch("builtins.print"):
+            self.assertEqual(_run(args, rep), 1)
+        rep.close()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        outcomes = Counter(r["outcome"] for r in records)
+        self.assertEqual(outcomes["already_licensed"], len(self.paths))
+        self.assertEqual(outcomes["error"], 1)
+        self.assertEqual(outcomes["ignored"], 2)  # LICENSE, report
+
+
+class TestCacheRun(RunTestCase):
+    def test_cache_unknown_syntax(self):
+        self.add_weird()
+        args = parser().parse_args(["-f", "-p", self.tmp, "-d", "2020",
+                                    "--cache", "-e", "John Doe"])
+        for _ in range(2):
+            with mock.patch("builtins.print"):
+                self.assertEqual(run(args), 1)
+            cache = license_cache(os.path.join(self.tmp, ".filecense-cache"))
+            self.assertEqual(len(cache.data), len(self.paths))
+
+
+class TestVcs(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = self.tmp.name
+        self.git("init", "-q")
+        for name in ["old.go", "edited.go"]:
+            self.write(name)
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "first")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        subprocess.run(["git", "-C", self.repo, "-c", "user.name=test",
+                        "-c", "user.email=test@example.com"] + list(args),
+                       check=True)
+
+    def write(self, name, content="package main\n"):
+        path = os.path.join(self.repo, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(content)
+
+    def test_changed_files(self):
+        self.write("sub/committed.go")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "second")
+        self.write("edited.go")
+        self.write("sub/untracked.go")
+        self.assertEqual(sorted(changed_files(self.repo, "HEAD~1")),
+                         ["edited.go", "sub/committed.go", "sub/untracked.go"])
+        self.assertEqual(sorted(changed_files(os.path.join(self.repo, "sub"),
+                                              "HEAD~1")),
+                         ["committed.go", "untracked.go"])
+        with self.assertRaises(RuntimeError):
+            changed_files(self.repo, "nosuchref")
+
+    def test_tracked_files(self):
+        self.write("sub/dir/nested.go")
+        os.symlink("old.go", os.path.join(self.repo, "link.go"))
+        self.git("add", ".")
+        index = os.path.join(self.repo, ".git", "index")
+        for version in ["2", "3", "4"]:
+            self.git("update-index", "--index-version", version)
+            self.assertEqual(read_index(index),
+                             ["edited.go", "old.go", "sub/dir/nested.go"])
+            self.assertEqual(tracked_files(os.path.join(self.repo, "sub")),
+                             ["dir/nested.go"])
+        with mock.patch("filecense.vcs.index_files",
+                        side_effect=ValueError("unsupported")):
+            self.assertEqual(tracked_files(self.repo),
+                             ["edited.go", "old.go", "sub/dir/nested.go"])
+
+    def test_gitignore(self):
+        self.write(".gitignore", "build/\n*.gen.go\n")
+        self.write(".git/info/exclude", "local.go\n")
+        self.write("sub/.gitignore", "/only_here.go\n!keep.gen.go\n")
+        for name in ["build/out.go", "sub/build/out.go", "a.gen.go",
+                     "sub/keep.gen.go", "sub/x.gen.go", "sub/only_here.go",
+                     "sub/deeper/only_here.go", "local.go", "sub/local.go"]:
+            self.write(name)
+        fndr = finder(False, ignore_items(const_ignore_dirs),
+                      ignore_items(const_ignore_files))
+        fndr.use_gitignore(self.repo)
+        found = [os.path.relpath(p, self.repo)
+                 for p in fndr.get_files(self.repo)]
+        self.assertEqual(sorted(found),
+                         ["edited.go", "old.go", "sub/deeper/only_here.go",
+                          "sub/keep.gen.go"])
+        self.assertEqual(fndr.gitignores, {})
+        sub = os.path.join(self.repo, "sub")
+        fndr.use_gitignore(sub)
+        found = [os.path.relpath(p, sub) for p in fndr.get_files(sub)]
+        self.assertEqual(sorted(found),
+                         ["deeper/only_here.go", "keep.gen.go"])
+
+    def test_gitignore_single_file(self):
+        self.write(".gitignore", "/gen/*.go\n")
+        self.write("sub/.gitignore", "/only_here.go\n")
+        for name in ["gen/x.go", "sub/only_here.go", "sub/kept.go"]:
+            self.write(name)
+        fndr = finder(False, ignore_items(const_ignore_dirs),
+                      ignore_items(const_ignore_files))
+        for name, found in [("gen/x.go", False), ("sub/only_here.go", False),
+                            ("sub/kept.go", True), ("old.go", True)]:
+            path = os.path.join(self.repo, name)
+            fndr.use_gitignore(path)
+            self.assertEqual(list(fndr.get_files(path)),
+                             [path] if found else [])
+        # and relative to the current directory, as -p gen/x.go gives it
+        cwd = os.getcwd()
+        os.chdir(self.repo)
+        try:
+            for name in ["gen/x.go", "old.go"]:
+                fndr.use_gitignore(name)
+                self.assertEqual(list(fndr.get_files(name)),
+                                 [] if name == "gen/x.go" else [name])
+        finally:
+            os.chdir(cwd)
+
+
+class TestTemplates(unittest.TestCase):
+    def test_registry(self):
+        registry = template_registry([template("gpl3", "gpl3", ("gpl",))])
+        gpl = registry["gpl"]
+        self.assertIs(gpl, registry["gpl3"])
+        self.assertEqual((gpl.name, gpl.aliases), ("gpl3", ("gpl",)))
+        self.assertEqual(list(registry), ["gpl3", "gpl"])
+        self.assertEqual(gpl.texts, {})
+        self.assertTrue(gpl.header.startswith("    Copyright (C) %d %s"))
+        self.assertEqual(list(gpl.texts), ["gpl3_header.txt"])
+        self.assertIn("GNU GENERAL PUBLIC LICENSE", gpl.full)
+        self.assertEqual(gpl[0], gpl.header)
+        self.assertNotIn("apache", templates.registry)
+        with self.assertRaises(KeyError):
+            templates.registry["apache"]
+
+    def test_legacy_names(self):
+        self.assertEqual(templates.euplTop, euplTop)
+        self.assertEqual(templates.euplTop, templates.registry["eupl"].header)
+        self.assertEqual(templates.gpl3, templates.registry["gpl"].full)
+        with self.assertRaises(AttributeError):
+            templates.nosuchTop
+
+
 class TestFunctions(unittest.TestCase):
     def test_syntax_arg(self):
         self.assertEqual(syntax_arg("hello=world"), ('hello', ['world']))
@@ -352,17 +981,304 @@ class TestFunctions(unittest.TestCase):
 class TestFindRoot(unittest.TestCase):
     def setUp(self):
         self.hardcoded_path = os.path.normpath(os.path.join(here,
-                                               "../testdata/.hiddenDir/.git"))
+                                               "../testdata/newdir/.git"))
         os.mkdir(self.hardcoded_path)
 
     def tearDown(self):
         os.rmdir(self.hardcoded_path)
 
     def test_find_root(self):
-        root = os.path.normpath(os.path.join(here, "../testdata"))
-        root_path = find_root(root)
+        nested = os.path.normpath(os.path.join(here,
+                                  "../testdata/newdir/nestedDir"))
+        root_path = find_root(nested)
         self.assertEqual(root_path, os.path.dirname(self.hardcoded_path))
         self.assertNotEqual(root_path, "../testdata")
+        self.assertEqual(find_root(nested, "/somewhere"), "/somewhere")
+        self.assertEqual(find_root(os.path.join(nested, "sourceFile.c")),
+                         os.path.dirname(self.hardcoded_path))
+        # answers are not kept between calls
+        os.rmdir(self.hardcoded_path)
+        try:
+            self.assertFalse(has_git(os.path.dirname(self.hardcoded_path)))
+            self.assertNotEqual(find_root(nested),
+                                os.path.dirname(self.hardcoded_path))
+        finally:
+            os.mkdir(self.hardcoded_path)
+
+    def test_find_root_from_walk(self):
+        root = os.path.normpath(os.path.join(here, "../testdata"))
+        fndr = finder(False, ignore_items(const_ignore_dirs),
+                      ignore_items(const_ignore_files))
+        list(fndr.get_files(root))
+        self.assertEqual(fndr.git_root, os.path.dirname(self.hardcoded_path))
+        self.assertEqual(find_root(root, fndr.git_root), fndr.git_root)
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.write("old.go")
+        self.finder = finder(False, ignore_items(const_ignore_dirs),
+                             ignore_items(const_ignore_files))
+        self.lcnsr = licenser(euplTop, file_format(), "", 2020, "John Doe")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("package main\n")
+        return path
+
+    def check_watch(self, backend, clock, wait):
+        w = watch(self.finder, self.lcnsr, 1.0, backend, clock)
+        self.assertEqual(list(self.finder.ignore(w.walk(self.root))),
+                         [os.path.join(self.root, "old.go")])
+        new = [self.write("new.go"), self.write("sub/nested.py")]
+        self.write("image.png")
+        self.write("node_modules/lib.js")
+        self.assertEqual(w.poll_once(wait), [])  # not quiet for long enough
+        self.assertEqual(sorted(w.pending), new)
+        clock.advance(2)
+        self.assertEqual(sorted(w.poll_once(0)), [(p, True) for p in new])
+        for path in new:
+            self.assertTrue(already_has_license(path, self.lcnsr.top(path)))
+        # renames of our own writes are seen but not licensed again
+        self.assertEqual(w.poll_once(wait), [])
+        clock.advance(2)
+        self.assertEqual(w.poll_once(0), [])
+        self.assertEqual(w.pending, {})
+        w.backend.close()
+
+    def test_poll(self):
+        self.check_watch(poller(sleep=lambda t: None), fake_clock(), 0)
+
+    def test_inotify(self):
+        try:
+            backend = inotify()
+        except (OSError, AttributeError, TypeError):
+            self.skipTest("inotify not available")
+        self.check_watch(backend, fake_clock(), 0.2)
+
+    def test_poll_gitignore(self):
+        os.mkdir(os.path.join(self.root, ".git"))
+        with open(os.path.join(self.root, ".gitignore"), "w") as f:
+            f.write("build/\n*.gen.go\n")
+        os.mkdir(os.path.join(self.root, "sub"))
+        with open(os.path.join(self.root, "sub", ".gitignore"), "w") as f:
+            f.write("*.skip.go\n")
+        self.finder.use_gitignore(self.root)
+        w = watch(self.finder, self.lcnsr, 1.0, poller(sleep=lambda t: None),
+                  fake_clock())
+        list(self.finder.ignore(w.walk(self.root)))
+        new = [self.write("new.go"), self.write("sub/deeper/kept.go")]
+        for name in ["build/out.go", "x.gen.go", "sub/a.skip.go",
+                     "sub/deeper/b.skip.go", "sub/deeper/build/c.go"]:
+            self.write(name)
+        w.poll_once(0)
+        self.assertEqual(sorted(w.pending), new)
+
+    def test_watch_before_listing(self):
+        created = []
+
+        # a file is created in each directory as soon as it is watched
+        class racing(poller):
+            def add(self, directory):
+                super().add(directory)
+                created.append(os.path.join(directory, "race.go"))
+                with open(created[-1], "w") as f:
+                    f.write("package main\n")
+
+        w = watch(self.finder, self.lcnsr, 1.0, racing(sleep=lambda t: None),
+                  fake_clock())
+        self.assertEqual(sorted(self.finder.ignore(w.walk(self.root))),
+                         sorted(created + [os.path.join(self.root,
+                                                        "old.go")]))
+
+    def test_watch_limit(self):
+        os.mkdir(os.path.join(self.root, "sub"))
+
+        # inotify that runs out of watches after the first directory
+        class limited:
+            def __init__(self):
+                self.poller = poller(sleep=lambda t: None)
+
+            def add(self, directory):
+                if self.poller.dirs:
+                    raise OSError(errno.ENOSPC, "No space left on device")
+                self.poller.add(directory)
+
+            def read(self, timeout):
+                return self.poller.read(0)
+
+            def close(self):
+                pass
+
+        w = watch(self.finder, self.lcnsr, 1.0, limited(), fake_clock())
+        with mock.patch("builtins.print"):
+            list(self.finder.ignore(w.walk(self.root)))
+        self.assertEqual(list(w.fallback.dirs),
+                         [os.path.join(self.root, "sub")])
+        new = [self.write("new.go"), self.write("sub/new.go")]
+        w.poll_once(0)
+        self.assertEqual(sorted(w.pending), new)
+
+    def test_watch_cache(self):
+        cache_path = os.path.join(self.root, ".filecense-cache")
+        args = parser().parse_args(["-f", "-p", self.root, "-d", "2020",
+                                    "--watch", "--cache", "-e", "John Doe"])
+
+        def run_watch(w, handle):
+            path = self.write("new.go")
+            license_file(path, self.lcnsr.header(path)[1])
+            handle(path, (True, None, 0.0))
+
+        with mock.patch("filecense.watch.watch.run", run_watch), \
+                mock.patch("builtins.print"):
+            self.assertEqual(run(args), 0)
+        self.assertEqual(sorted(license_cache(cache_path).data),
+                         ["new.go", "old.go"])
+
+    def test_watch_flags(self):
+        args = parser().parse_args(["--watch", "--debounce", "2"])
+        self.assertTrue(args.watch)
+        self.assertEqual(args.debounce, 2)
+
+
+class fake_clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestTiming(unittest.TestCase):
+    def test_phase_timer(self):
+        now = [0.0]
+        timer = phase_timer(clock=lambda: now[0])
+
+        def walk():
+            for name in ["a.go", "b.go"]:
+                now[0] += 1
+                yield name
+            now[0] += 1
+
+        with timer.phase("license"):
+            for _ in timer.wrap("discover", walk()):
+                now[0] += 2
+                timer.count("license", 1, 10, 20)
+        self.assertEqual(timer.phases["discover"].seconds, 3)
+        self.assertEqual(timer.phases["discover"].files, 2)
+        self.assertEqual(timer.phases["license"].seconds, 4)
+        self.assertEqual(timer.phases["license"].written, 40)
+        lines = timer.summary([("newly licensed", 2)]).splitlines()
+        self.assertEqual(lines[-2].split(),
+                         ["total", "7.000", "2", "0.3", "20", "40"])
+        self.assertEqual(lines[-1], "newly licensed 2")
+        self.assertTrue(parser().parse_args(["--profile"]).profile)
+        steps = [("", [], ["a.go", "b.go"]), ("sub", [], ["c.go"])]
+        self.assertEqual(list(timer.wrap("walk", steps,
+                                         lambda step: len(step[2]))), steps)
+        self.assertEqual(timer.phases["walk"].files, 3)
+
+    def test_detect_write(self):
+        body = b"#!/bin/sh\n" + b"x = 1\n" * 2000
+        top = b"// header\n"
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "main.go")
+            # 1 maps the file
+            for threshold in [mmap_threshold, 1]:
+                with open(path, "wb") as f:
+                    f.write(body)
+                timer = phase_timer()
+                self.assertTrue(license_file(path, top, None, threshold,
+                                             timer))
+                detect = timer.phases["detect"]
+                write = timer.phases["write"]
+                self.assertEqual((detect.files, write.files), (1, 1))
+                self.assertGreaterEqual(detect.read, len(top))
+                # the mapping is copied from the shebang on, so the probe
+                # for the header is read twice
+                again = len(top) + 1 if threshold == 1 else 0
+                self.assertEqual(detect.read + write.read, len(body) + again)
+                self.assertEqual(write.written, os.path.getsize(path))
+                self.assertFalse(license_file(path, top, None, threshold,
+                                              timer))
+                self.assertEqual((detect.files, write.files), (2, 1))
+
+    def test_profile_call(self):
+        def busy(n):
+            deadline = time.perf_counter() + n
+            while time.perf_counter() < deadline:
+                pass
+            return n
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "run.pstats")
+            self.assertEqual(profile_call(busy, (0.01,), path), 0.01)
+            names = [func[2] for func in pstats.Stats(path).stats]
+            self.assertIn("busy", names)
+            # calls in pool threads are in the profile too
+            profile_call(lambda: list(execute(busy, [0.01] * 4, 2)), (),
+                         path)
+            counts = {func[2]: stat[1]
+                      for func, stat in pstats.Stats(path).stats.items()}
+            self.assertEqual(counts.get("busy"), 4)
+            path = os.path.join(tmp, "run.txt")
+            profile_call(busy, (0.1,), path, "sample", 0.001)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(any(";busy (" in line for line in lines))
+            self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit()
+                                for line in lines))
+        args = parser().parse_args(["--profile-out", "x", "--profile-mode",
+                                    "sample"])
+        self.assertEqual((args.profile_out, args.profile_mode),
+                         ("x", "sample"))
+
+
+# cumulative microseconds of all imports of a run on a single file,
+# about three times what a cold start without bytecode caches takes
+import_budget = 200000
+heavy_modules = ["asyncio", "concurrent.futures", "datetime", "hashlib",
+                 "multiprocessing", "pathlib", "subprocess", "filecense.aio",
+                 "filecense.cache", "filecense.profiling", "filecense.report",
+                 "filecense.vcs", "filecense.watch"]
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_budget(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.abspath(os.path.join(here, ".."))] +
+            ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "main.go")
+            with open(path, "w") as f:
+                f.write("package main\n")
+            proc = subprocess.run([sys.executable, "-X", "importtime", "-m",
+                                   "filecense", "-f", "-p", path, "John"],
+                                  cwd=d, env=env, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  universal_newlines=True, check=True)
+            with open(path) as f:
+                self.assertTrue(f.read().startswith("//\n// Copyright"))
+        rows = [line.split("|") for line in proc.stderr.splitlines()
+                if line.startswith("import time:")][1:]
+        loaded = [r[2].strip() for r in rows]
+        self.assertIn("filecense.logic", loaded)
+        for name in heavy_modules:
+            self.assertNotIn(name, loaded)
+        # rows of imports done by other imports are indented further
+        total = sum(int(r[1]) for r in rows if not r[2].startswith("  "))
+        self.assertLess(total, import_budget)
 
 
 if __name__ == '__main__':